@@ -1,8 +1,14 @@
 import asyncio
 import logging
+import multiprocessing
 import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
 from enum import Enum
+from functools import partial
 from time import monotonic
 
 import aiohttp
@@ -13,11 +19,21 @@ from bs4 import BeautifulSoup
 
 from adapters.inosmi_ru import sanitize
 from adapters.exceptions import ArticleNotFound
-from text_tools import split_by_words, calculate_jaundice_rate
+from result_cache import ResultCache, normalize_url
+from text_tools import (
+    LEMMA_CACHE_SIZE,
+    ChargedWordsMatcher,
+    LemmaCache,
+    calculate_jaundice_rate,
+    split_by_words_sync,
+)
 
 
 logger = logging.getLogger('jaundice_rate')
 
+# MorphAnalyzer и заряженные слова процесса-анализатора, их загружает init_analysis_worker
+_worker_state = {}
+
 
 class ProcessingStatus(Enum):
     OK = 'OK'
@@ -30,15 +46,23 @@ class ProcessingStatus(Enum):
 
 
 def get_charged_words(charged_dict_path):
+    """Читает заряженные слова и фразы, выкидывая пустые строки и уточнения в скобках: «измена (супруга)»."""
     words = []
 
-    for path in os.listdir(charged_dict_path):
+    for path in sorted(os.listdir(charged_dict_path)):
         with open(os.path.join(charged_dict_path, path)) as file:
-            words.extend(file.read().split('\n'))
+            for line in file:
+                word = re.sub(r'\(.*?\)', '', line).strip()
+                if word:
+                    words.append(word)
 
     return words
 
 
+def load_charged_words(charged_dict_path, lemma_cache):
+    return ChargedWordsMatcher(get_charged_words(charged_dict_path), lemma_cache)
+
+
 def get_title_from_html(html):
     soup = BeautifulSoup(html, 'html.parser')
     title = soup.find('title')
@@ -54,23 +78,114 @@ def time_it():
     logger.debug(f'Анализ закончен за {end_time - start_time:.2f} сек')
 
 
+def analyze_article(html, lemma_cache, charged_words):
+    """Возвращает заголовок, желтушность, число слов статьи и найденные заряженные слова.
+
+    Если статьи на странице нет, бросает ArticleNotFound.
+    """
+    title, plaintext = sanitize(html, plaintext=True)
+    splitted_by_words_text = split_by_words_sync(lemma_cache, plaintext)
+    score, found_charged_words = calculate_jaundice_rate(splitted_by_words_text, charged_words)
+    return title, score, len(splitted_by_words_text), found_charged_words
+
+
+def init_analysis_worker(charged_dict_path, lemma_cache_size):
+    lemma_cache = LemmaCache(pymorphy2.MorphAnalyzer(), maxsize=lemma_cache_size)
+    _worker_state['lemma_cache'] = lemma_cache
+    _worker_state['charged_words'] = load_charged_words(charged_dict_path, lemma_cache)
+
+
+def analyze_article_in_worker(html):
+    """Возвращает вместе с результатом analyze_article pid процесса и счётчики его кэша лемм."""
+    lemma_cache = _worker_state['lemma_cache']
+    return analyze_article(html, lemma_cache, _worker_state['charged_words']), os.getpid(), lemma_cache.as_dict()
+
+
+class AnalysisExecutor(ProcessPoolExecutor):
+    """ProcessPoolExecutor, который умеет отменить анализы, ещё не переданные процессам.
+
+    shutdown(cancel_futures=True) появился только в Python 3.9, а образ Docker собран на Python 3.8,
+    поэтому незавершённые задачи executor помнит сам.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._futures = set()
+        self._futures_lock = threading.Lock()
+        # Последние счётчики кэша лемм каждого процесса-анализатора по его pid
+        self.lemma_caches = {}
+
+    async def analyze(self, html):
+        """Разбирает статью в процессе-анализаторе и запоминает счётчики его кэша лемм."""
+        loop = asyncio.get_running_loop()
+        result, pid, lemma_cache_stats = await loop.run_in_executor(self, analyze_article_in_worker, html)
+        self.lemma_caches[pid] = lemma_cache_stats
+        return result
+
+    def lemma_cache_as_dict(self):
+        """Складывает счётчики кэшей лемм процессов-анализаторов, которые уже разобрали хоть одну статью."""
+        hits = sum(stats['hits'] for stats in self.lemma_caches.values())
+        misses = sum(stats['misses'] for stats in self.lemma_caches.values())
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 3) if hits + misses else 0,
+            'size': sum(stats['size'] for stats in self.lemma_caches.values()),
+            'maxsize': sum(stats['maxsize'] for stats in self.lemma_caches.values()),
+            'processes': len(self.lemma_caches),
+        }
+
+    def _forget(self, future):
+        # Колбэк вызывает поток, который раздаёт задачи процессам, поэтому множество под замком
+        with self._futures_lock:
+            self._futures.discard(future)
+
+    def submit(self, *args, **kwargs):
+        future = super().submit(*args, **kwargs)
+        with self._futures_lock:
+            self._futures.add(future)
+        future.add_done_callback(self._forget)
+        return future
+
+    def cancel_pending(self):
+        """Отменяет задачи, которые ещё ждут процесса. Уже начатые cancel не прерывает."""
+        with self._futures_lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+
+
+def create_analysis_executor(workers_number, charged_dict_path, lemma_cache_size=LEMMA_CACHE_SIZE):
+    """Запускает процессы, которые разбирают статьи, пока цикл событий занят только сетью.
+
+    Каждый процесс один раз при старте загружает свой MorphAnalyzer и заряженные слова.
+    Процессы запускаются через spawn: fork посреди работающего цикла событий aiohttp небезопасен.
+    """
+    return AnalysisExecutor(
+        max_workers=workers_number,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_analysis_worker,
+        initargs=(charged_dict_path, lemma_cache_size),
+    )
+
+
 async def fetch(session, url):
     async with session.get(url) as response:
         response.raise_for_status()
         return await response.text()
 
 
-async def process_article(session, morph, charged_words, url, max_timeout, results):
-    score, words_count = None, None
+async def analyze_url(session, lemma_cache, charged_words, url, max_timeout, executor=None):
+    score, words_count, found_charged_words = None, None, None
     try:
         async with timeout(max_timeout):
             html = await fetch(session, url)
             status = str(ProcessingStatus.OK)
             with time_it():
-                title, plaintext = sanitize(html, plaintext=True)
-                splitted_by_words_text = await split_by_words(morph, plaintext)
-                score = calculate_jaundice_rate(splitted_by_words_text, charged_words)
-                words_count = len(splitted_by_words_text)
+                if executor:
+                    title, score, words_count, found_charged_words = await executor.analyze(html)
+                else:
+                    title, score, words_count, found_charged_words = analyze_article(html, lemma_cache, charged_words)
 
     except aiohttp.ClientError:
         status = str(ProcessingStatus.FETCH_ERROR)
@@ -84,41 +199,62 @@ async def process_article(session, morph, charged_words, url, max_timeout, resul
         status = str(ProcessingStatus.TIMEOUT)
         title = None
 
-    results.append(
-        {
-            'status': status,
-            'url': url,
-            'title': title,
-            'score': score,
-            'words_count': words_count,
-        }
-    )
+    return {
+        'status': status,
+        'url': url,
+        'title': title,
+        'score': score,
+        'words_count': words_count,
+        'charged_words': found_charged_words,
+    }
+
+
+def is_result_cacheable(result):
+    """Ошибки сети и таймауты могут пройти сами, их не запоминаем."""
+    return result['status'] in (str(ProcessingStatus.OK), str(ProcessingStatus.PARSING_ERROR))
 
 
-async def get_process_article_results(urls, morph, charged_words, max_timeout):
+async def process_article(
+    session, lemma_cache, charged_words, url, max_timeout, results, executor=None, result_cache=None
+):
+    analyze = partial(analyze_url, session, lemma_cache, charged_words, url, max_timeout, executor)
+    if result_cache is None:
+        result = await analyze()
+    else:
+        key = (normalize_url(url), charged_words.version)
+        result = await result_cache.get_or_create(key, analyze)
+
+    # Результат из кэша мог быть посчитан для другого написания того же адреса
+    results.append({**result, 'url': url})
+
+
+async def get_process_article_results(
+    urls, session, lemma_cache, charged_words, max_timeout, executor=None, result_cache=None
+):
     process_article_results = []
-    async with aiohttp.ClientSession() as session:
-        async with create_task_group() as task_group:
-            for url in urls:
-                await task_group.spawn(
-                    process_article,
-                    session,
-                    morph,
-                    charged_words,
-                    url,
-                    max_timeout,
-                    process_article_results
-                )
+    async with create_task_group() as task_group:
+        for url in urls:
+            await task_group.spawn(
+                process_article,
+                session,
+                lemma_cache,
+                charged_words,
+                url,
+                max_timeout,
+                process_article_results,
+                executor,
+                result_cache
+            )
     return process_article_results
 
 
 async def run_process_article(url, status, max_timeout):
-    morph = pymorphy2.MorphAnalyzer()
-    charged_words = get_charged_words('charged_dict')
+    lemma_cache = LemmaCache(pymorphy2.MorphAnalyzer())
+    charged_words = load_charged_words('charged_dict', lemma_cache)
     results = []
 
     async with aiohttp.ClientSession() as session:
-        await process_article(session, morph, charged_words, url, max_timeout, results)
+        await process_article(session, lemma_cache, charged_words, url, max_timeout, results)
         assert results[0]['status'] == status
 
 
@@ -138,3 +274,57 @@ def test_process_article_fetch_error():
     url = 'https://xxx-yyy.zzz/'
     status = 'FETCH ERROR'
     asyncio.run(run_process_article(url, status, max_timeout=5))
+
+
+async def run_process_broken_urls(urls):
+    lemma_cache = LemmaCache(pymorphy2.MorphAnalyzer())
+    charged_words = ChargedWordsMatcher(['аутсайдер'], lemma_cache)
+    async with aiohttp.ClientSession() as session:
+        return await get_process_article_results(
+            urls, session, lemma_cache, charged_words, max_timeout=5, result_cache=ResultCache()
+        )
+
+
+def test_process_article_broken_url():
+    # Адрес, который не разбирает даже urlsplit, не должен ронять запрос с кэшем результатов
+    urls = ['http://inosmi.ru:abc/', 'http://[::1/']
+    results = asyncio.run(run_process_broken_urls(urls))
+    assert sorted((result['url'], result['status']) for result in results) == sorted(
+        (url, 'FETCH ERROR') for url in urls
+    )
+
+
+def test_analyze_article():
+    html = """
+        <html><body>
+            <h1 class="article-header__title">Заголовок</h1>
+            <article class="article"><p>Аутсайдер снова проиграл, но не сдался.</p></article>
+        </body></html>
+    """
+    lemma_cache = LemmaCache(pymorphy2.MorphAnalyzer())
+    charged_words = ChargedWordsMatcher(['аутсайдер'], lemma_cache)
+    assert analyze_article(html, lemma_cache, charged_words) == ('Заголовок', 20.0, 5, {'аутсайдер': 1})
+
+    with create_analysis_executor(1, 'charged_dict') as executor:
+        title, _, words_count, found_charged_words = asyncio.run(executor.analyze(html))
+        assert (title, words_count, found_charged_words) == ('Заголовок', 5, {'аутсайдер': 1})
+        # Кэш лемм в /stats — это кэш процесса-анализатора, а не основного процесса
+        assert executor.lemma_cache_as_dict()['processes'] == 1
+        assert executor.lemma_cache_as_dict()['misses'] > 0
+
+
+def test_analysis_executor_cancel_pending():
+    executor = AnalysisExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+    # Один процесс работает, ещё одна задача ждёт в очереди к процессам, остальные отменить можно
+    futures = [executor.submit(time.sleep, 0.2) for _ in range(4)]
+    executor.cancel_pending()
+    executor.shutdown()
+
+    assert futures[-1].cancelled() and not futures[0].cancelled()
+    assert not executor._futures
+
+
+def test_get_charged_words():
+    charged_words = get_charged_words('charged_dict')
+    assert 'измена' in charged_words and 'медовый месяц' in charged_words
+    assert all(word and word == word.strip() for word in charged_words)
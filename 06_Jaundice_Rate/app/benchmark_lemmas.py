@@ -0,0 +1,67 @@
+import argparse
+import asyncio
+import os
+from time import monotonic
+
+import pymorphy2
+
+from adapters.exceptions import ArticleNotFound
+from adapters.inosmi_ru import sanitize
+from text_tools import LEMMA_CACHE_SIZE, LemmaCache, split_by_words
+
+
+def load_corpus(corpus_path):
+    """Читает сохранённые статьи: HTML-страницы ИНОСМИ.РУ чистит адаптером, .txt берёт как есть."""
+    texts = []
+    for filename in sorted(os.listdir(corpus_path)):
+        with open(os.path.join(corpus_path, filename), encoding='utf-8') as file:
+            text = file.read()
+
+        if filename.endswith('.html'):
+            try:
+                _, text = sanitize(text, plaintext=True)
+            except ArticleNotFound:
+                continue
+        texts.append(text)
+
+    return texts
+
+
+async def measure(lemma_cache, texts):
+    tokens_number = sum(len(text.split()) for text in texts)
+    start_time = monotonic()
+    for text in texts:
+        await split_by_words(lemma_cache, text)
+    return tokens_number / (monotonic() - start_time)
+
+
+async def run_benchmark(corpus_path, cache_size, rounds):
+    texts = load_corpus(corpus_path)
+    print(f'Статей: {len(texts)}, слов: {sum(len(text.split()) for text in texts)}')
+
+    morph = pymorphy2.MorphAnalyzer()
+    # Первый разбор подгружает словари pymorphy2, его не считаем
+    morph.parse('прогрев')
+    tokens_per_second = await measure(LemmaCache(morph, maxsize=0), texts)
+    print(f'Без кэша: {tokens_per_second:.0f} слов/с')
+
+    # Кэш общий для всех запросов сервера, поэтому важна скорость и на первом проходе, и на повторных
+    lemma_cache = LemmaCache(morph, maxsize=cache_size)
+    for round_number in range(1, rounds + 1):
+        tokens_per_second = await measure(lemma_cache, texts)
+        print(f'С кэшем, проход {round_number}: {tokens_per_second:.0f} слов/с')
+    print(f'Кэш: {lemma_cache.as_dict()}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнивает скорость разбора статей на слова с кэшем лемм и без него')
+    parser.add_argument('corpus', help='Каталог с сохранёнными статьями: .html со страницами ИНОСМИ.РУ или .txt')
+    parser.add_argument('--cache-size', type=int, default=LEMMA_CACHE_SIZE, help='Размер кэша лемм')
+    parser.add_argument('--rounds', type=int, default=3, help='Сколько раз прогнать корпус через один кэш')
+    args = parser.parse_args()
+
+    asyncio.run(run_benchmark(args.corpus, args.cache_size, args.rounds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import asyncio
+from collections import Counter
+
+import aiohttp
+from aiohttp import web
+
+
+HTTP_CONNECTIONS_LIMIT = 100
+HTTP_CONNECTIONS_PER_HOST = 10
+DNS_CACHE_TTL = 300
+
+# Какие события aiohttp считать: имя счётчика и сигнал TraceConfig
+TRACED_EVENTS = {
+    'requests': 'on_request_start',
+    'requests_finished': 'on_request_end',
+    'requests_failed': 'on_request_exception',
+    'connections_created': 'on_connection_create_end',
+    'connections_reused': 'on_connection_reuseconn',
+    'connections_queued': 'on_connection_queued_start',
+    'dns_cache_hits': 'on_dns_cache_hit',
+    'dns_cache_misses': 'on_dns_cache_miss',
+}
+
+
+class HttpClient:
+    """Одна ClientSession на всё приложение, чтобы статьи скачивались по уже открытым соединениям.
+
+    Сессия создаётся при запуске приложения aiohttp и закрывается при остановке. Соединения,
+    кэш DNS и сессии TLS переживают запрос браузера, а limit и limit_per_host ограничивают,
+    сколько соединений открыто всего и к одному сайту.
+    """
+
+    def __init__(
+        self,
+        limit=HTTP_CONNECTIONS_LIMIT,
+        limit_per_host=HTTP_CONNECTIONS_PER_HOST,
+        dns_cache_ttl=DNS_CACHE_TTL,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.session = None
+        self.counters = Counter()
+
+    def _create_trace_config(self):
+        trace_config = aiohttp.TraceConfig()
+        for name, signal in TRACED_EVENTS.items():
+            async def count(session, trace_config_ctx, params, name=name):
+                self.counters[name] += 1
+            getattr(trace_config, signal).append(count)
+        return trace_config
+
+    async def start(self, app=None):
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.dns_cache_ttl,
+        )
+        self.session = aiohttp.ClientSession(connector=connector, trace_configs=[self._create_trace_config()])
+
+    async def close(self, app=None):
+        await self.session.close()
+
+    def as_dict(self):
+        finished = self.counters['requests_finished'] + self.counters['requests_failed']
+        return {
+            'limit': self.limit,
+            'limit_per_host': self.limit_per_host,
+            'dns_cache_ttl': self.dns_cache_ttl,
+            'requests': self.counters['requests'],
+            'requests_in_flight': self.counters['requests'] - finished,
+            **{name: self.counters[name] for name in TRACED_EVENTS if name.startswith(('connections', 'dns'))},
+        }
+
+
+async def run_http_client():
+    async def handle(request):
+        return web.Response(text='ok')
+
+    app = web.Application()
+    app.add_routes([web.get('/', handle)])
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port = runner.addresses[0]
+
+    http_client = HttpClient()
+    await http_client.start()
+    try:
+        for _ in range(3):
+            async with http_client.session.get(f'http://{host}:{port}/') as response:
+                assert await response.text() == 'ok'
+    finally:
+        await http_client.close()
+        await runner.cleanup()
+
+    stats = http_client.as_dict()
+    assert (stats['requests'], stats['requests_in_flight']) == (3, 0)
+    assert (stats['connections_created'], stats['connections_reused']) == (1, 2)
+
+
+def test_http_client():
+    asyncio.run(run_http_client())
@@ -0,0 +1,182 @@
+import asyncio
+import json
+from collections import OrderedDict
+from time import monotonic
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+RESULT_CACHE_SIZE = 1000
+RESULT_CACHE_BYTES = 10 * 1024 * 1024
+RESULT_CACHE_TTL = 3600
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url):
+    """Приводит к одному виду адреса одной и той же страницы: регистр хоста, порт по умолчанию, порядок параметров.
+
+    Адрес, который не удалось разобрать, например с нечисловым портом, остаётся ключом как есть:
+    скачать его всё равно не выйдет, и ошибка достанется этой статье, а не всему запросу.
+    """
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if port and port != DEFAULT_PORTS.get(scheme):
+        host = f'{host}:{port}'
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, parts.path or '/', query, ''))
+
+
+def get_size(value):
+    return len(json.dumps(value, ensure_ascii=False).encode())
+
+
+class ResultCache:
+    """Хранит результаты анализа статей, пока не истечёт ttl секунд.
+
+    Давно не запрошенные результаты вытесняются, когда записей больше max_entries или они занимают
+    больше max_bytes байт в JSON. Пока статья анализируется, остальные запросы того же ключа ждут
+    этот анализ, а не запускают свой. Результаты, для которых is_cacheable вернула False, например
+    ошибки сети, отдаются ждущим, но не запоминаются.
+    """
+
+    def __init__(
+        self,
+        max_entries=RESULT_CACHE_SIZE,
+        max_bytes=RESULT_CACHE_BYTES,
+        ttl=RESULT_CACHE_TTL,
+        is_cacheable=lambda value: True,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.is_cacheable = is_cacheable
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._in_flight = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        value, size, expires_at = entry
+        if expires_at <= monotonic():
+            self._remove(key)
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        size = get_size(value)
+        if size > self.max_bytes:
+            return
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, size, monotonic() + self.ttl)
+        self.bytes += size
+
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def _finish(self, key, task):
+        del self._in_flight[key]
+        if not task.cancelled() and not task.exception() and self.is_cacheable(task.result()):
+            self.put(key, task.result())
+
+    async def get_or_create(self, key, create):
+        """Возвращает результат из кэша, а если его нет — ждёт create() или уже запущенный кем-то анализ.
+
+        create выполняется в отдельной задаче: если запрос, который её запустил, отменят, остальные
+        всё равно дождутся результата.
+        """
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        task = self._in_flight.get(key)
+        if task:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(create())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda task: self._finish(key, task))
+
+        return await asyncio.shield(task)
+
+    def as_dict(self):
+        requests_number = self.hits + self.misses + self.coalesced
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_rate': round(self.hits / requests_number, 3) if requests_number else 0,
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'in_flight': len(self._in_flight),
+        }
+
+
+def test_normalize_url():
+    assert normalize_url('HTTPS://InoSMI.ru:443/politic/1.html?b=2&a=1#comments') == 'https://inosmi.ru/politic/1.html?a=1&b=2'
+    assert normalize_url('http://inosmi.ru') == 'http://inosmi.ru/'
+    assert normalize_url('http://localhost:8080/a') == 'http://localhost:8080/a'
+    for url in ('http://inosmi.ru:abc/', 'http://inosmi.ru:70000/', 'http://[::1/'):
+        assert normalize_url(url) == url
+
+
+def test_result_cache_eviction():
+    cache = ResultCache(max_entries=2, max_bytes=40)
+    cache.put('a', 'a' * 10)
+    cache.put('b', 'b' * 10)
+    cache.get('a')
+    cache.put('c', 'c' * 10)
+    assert (cache.get('a'), cache.get('b')) == ('a' * 10, None)
+
+    cache.put('d', 'd' * 30)
+    assert (len(cache), cache.bytes) == (1, 32)
+
+    cache.ttl = 0
+    cache.put('e', 'e')
+    assert cache.get('e') is None
+
+
+async def run_result_cache_coalescing():
+    cache = ResultCache(is_cacheable=lambda value: value != 'error')
+    calls = []
+
+    async def create(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value
+
+    results = await asyncio.gather(*(cache.get_or_create('key', lambda: create('result')) for _ in range(3)))
+    assert results == ['result'] * 3 and calls == ['result']
+    assert await cache.get_or_create('key', lambda: create('other')) == 'result'
+
+    await cache.get_or_create('error', lambda: create('error'))
+    await cache.get_or_create('error', lambda: create('error'))
+    assert calls == ['result', 'error', 'error']
+    assert (cache.hits, cache.misses, cache.coalesced) == (1, 3, 2)
+
+
+def test_result_cache_coalescing():
+    asyncio.run(run_result_cache_coalescing())
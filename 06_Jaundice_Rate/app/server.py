@@ -7,9 +7,14 @@ import pymorphy2
 from aiohttp import web
 
 from article_tools import (
-    get_charged_words,
-    get_process_article_results
+    create_analysis_executor,
+    get_process_article_results,
+    is_result_cacheable,
+    load_charged_words
 )
+from http_client import DNS_CACHE_TTL, HTTP_CONNECTIONS_LIMIT, HTTP_CONNECTIONS_PER_HOST, HttpClient
+from result_cache import RESULT_CACHE_BYTES, RESULT_CACHE_SIZE, RESULT_CACHE_TTL, ResultCache
+from text_tools import LEMMA_CACHE_SIZE, LemmaCache
 
 
 CHARGED_DICT_PATH = 'charged_dict'
@@ -31,26 +36,55 @@ def get_urls(request, max_urls_in_request):
     return urls
 
 
-async def handle_articles(request, morph, charged_words, json_encoder, max_urls_in_request, max_timeout):
+async def handle_articles(
+    request, http_client, lemma_cache, charged_words, json_encoder, max_urls_in_request, max_timeout, executor,
+    result_cache
+):
     urls = get_urls(request, max_urls_in_request)
-    article_results = await get_process_article_results(urls, morph, charged_words, max_timeout)
+    article_results = await get_process_article_results(
+        urls, http_client.session, lemma_cache, charged_words, max_timeout, executor, result_cache
+    )
 
     return web.json_response({'result': article_results}, dumps=json_encoder)
 
 
+async def handle_stats(request, http_client, lemma_cache, result_cache, json_encoder, executor=None):
+    # С процессами-анализаторами кэш лемм основного процесса нужен только для загрузки словаря
+    lemma_cache_stats = executor.lemma_cache_as_dict() if executor else lemma_cache.as_dict()
+    stats = {'http_client': http_client.as_dict(), 'lemma_cache': lemma_cache_stats}
+    if result_cache:
+        stats['result_cache'] = result_cache.as_dict()
+    return web.json_response(stats, dumps=json_encoder)
+
+
 def main():
     env = Env()
     env.read_env()
     
     max_urls_in_request = env.int('MAX_URLS_IN_REQUEST', 10)
     max_timeout = env.int('MAX_TIMEOUT', 3)
+    lemma_cache_size = env.int('LEMMA_CACHE_SIZE', LEMMA_CACHE_SIZE)
+    analysis_workers = env.int('ANALYSIS_WORKERS', 0)
+    result_cache_size = env.int('RESULT_CACHE_SIZE', RESULT_CACHE_SIZE)
+    result_cache_bytes = env.int('RESULT_CACHE_BYTES', RESULT_CACHE_BYTES)
+    result_cache_ttl = env.int('RESULT_CACHE_TTL', RESULT_CACHE_TTL)
+    http_connections_limit = env.int('HTTP_CONNECTIONS_LIMIT', HTTP_CONNECTIONS_LIMIT)
+    http_connections_per_host = env.int('HTTP_CONNECTIONS_PER_HOST', HTTP_CONNECTIONS_PER_HOST)
+    dns_cache_ttl = env.int('DNS_CACHE_TTL', DNS_CACHE_TTL)
     debug = env.bool('DEBUG', False)
 
     if debug:
         logging.basicConfig(level=logging.DEBUG)
 
-    morph = pymorphy2.MorphAnalyzer()
-    charged_words = get_charged_words(CHARGED_DICT_PATH)
+    http_client = HttpClient(http_connections_limit, http_connections_per_host, dns_cache_ttl)
+    lemma_cache = LemmaCache(pymorphy2.MorphAnalyzer(), maxsize=lemma_cache_size)
+    charged_words = load_charged_words(CHARGED_DICT_PATH, lemma_cache)
+    executor = None
+    if analysis_workers:
+        executor = create_analysis_executor(analysis_workers, CHARGED_DICT_PATH, lemma_cache_size)
+    result_cache = None
+    if result_cache_size:
+        result_cache = ResultCache(result_cache_size, result_cache_bytes, result_cache_ttl, is_result_cacheable)
 
     json_encoder = partial(
         json.dumps,
@@ -59,16 +93,38 @@ def main():
     )
     handle = partial(
         handle_articles,
-        morph=morph,
+        http_client=http_client,
+        lemma_cache=lemma_cache,
         charged_words=charged_words,
         json_encoder=json_encoder,
         max_urls_in_request=max_urls_in_request,
-        max_timeout=max_timeout
+        max_timeout=max_timeout,
+        executor=executor,
+        result_cache=result_cache
+    )
+
+    handle_stats_request = partial(
+        handle_stats,
+        http_client=http_client,
+        lemma_cache=lemma_cache,
+        result_cache=result_cache,
+        json_encoder=json_encoder,
+        executor=executor,
     )
 
     app = web.Application()
-    app.add_routes([web.get('/', handle)])
-    web.run_app(app)
+    app.on_startup.append(http_client.start)
+    app.on_cleanup.append(http_client.close)
+    app.add_routes([
+        web.get('/', handle),
+        web.get('/stats', handle_stats_request),
+    ])
+    try:
+        web.run_app(app)
+    finally:
+        if executor:
+            executor.cancel_pending()
+            executor.shutdown(wait=False)
 
 
 if __name__ == '__main__':
@@ -1,9 +1,17 @@
 import asyncio
+import hashlib
 import string
+from collections import Counter
+from functools import lru_cache
 
 import pymorphy2
 
 
+# Сколько словоформ помнить вместе с их нормальными формами. Словарь новостей небольшой, так что
+# 100 тысяч слов хватает почти на все статьи, а памяти это занимает десяток-другой мегабайт
+LEMMA_CACHE_SIZE = 100_000
+
+
 def _clean_word(word):
     word = word.replace('«', '').replace('»', '').replace('…', '')
     # FIXME какие еще знаки пунктуации часто встречаются ?
@@ -11,43 +19,161 @@ def _clean_word(word):
     return word
 
 
-async def split_by_words(morph, text):
+class LemmaCache:
+    """Запоминает нормальные формы слов, которые уже разбирал MorphAnalyzer.
+
+    Слова в новостях часто повторяются, и без кэша pymorphy2 разбирает их заново в каждой статье.
+    Вытесняются давно не встречавшиеся слова.
+    """
+
+    def __init__(self, morph, maxsize=LEMMA_CACHE_SIZE):
+        self.morph = morph
+        self.get_lemma = lru_cache(maxsize=maxsize)(self._parse)
+
+    def _parse(self, word):
+        return self.morph.parse(word)[0].normal_form
+
+    def as_dict(self):
+        hits, misses, maxsize, size = self.get_lemma.cache_info()
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 3) if hits + misses else 0,
+            'size': size,
+            'maxsize': maxsize,
+        }
+
+
+def _normalize_word(lemma_cache, word):
+    normalized_word = lemma_cache.get_lemma(_clean_word(word))
+    if len(normalized_word) > 2 or normalized_word == 'не':
+        return normalized_word
+
+
+async def split_by_words(lemma_cache, text):
     """Учитывает знаки пунктуации, регистр и словоформы, выкидывает предлоги."""
     words = []
     for word in text.split():
-        cleaned_word = _clean_word(word)
-        normalized_word = morph.parse(cleaned_word)[0].normal_form
-        if len(normalized_word) > 2 or normalized_word == 'не':
+        normalized_word = _normalize_word(lemma_cache, word)
+        if normalized_word:
             words.append(normalized_word)
         await asyncio.sleep(0)
     return words
 
 
-async def run_split_by_word(morph):
-    assert await split_by_words(morph, 'Во-первых, он хочет, чтобы') == ['во-первых', 'хотеть', 'чтобы']
-    assert await split_by_words(morph, '«Удивительно, но это стало началом!»') == ['удивительно', 'это', 'стать', 'начало']
+def split_by_words_sync(lemma_cache, text):
+    """То же, что split_by_words, но не отдаёт управление циклу событий: для процессов-анализаторов."""
+    words = (_normalize_word(lemma_cache, word) for word in text.split())
+    return [word for word in words if word]
+
+
+async def run_split_by_word(lemma_cache):
+    assert await split_by_words(lemma_cache, 'Во-первых, он хочет, чтобы') == ['во-первых', 'хотеть', 'чтобы']
+    assert await split_by_words(lemma_cache, '«Удивительно, но это стало началом!»') == ['удивительно', 'это', 'стать', 'начало']
 
 
 def test_split_by_words():
     # Экземпляры MorphAnalyzer занимают 10-15Мб RAM т.к. загружают в память много данных
     # Старайтесь организовать свой код так, чтоб создавать экземпляр MorphAnalyzer заранее и в единственном числе
     morph = pymorphy2.MorphAnalyzer()
-    asyncio.run(run_split_by_word(morph))
+    asyncio.run(run_split_by_word(LemmaCache(morph)))
+    assert split_by_words_sync(LemmaCache(morph), '«Удивительно, но это стало началом!»') == ['удивительно', 'это', 'стать', 'начало']
+
+
+def test_lemma_cache():
+    lemma_cache = LemmaCache(pymorphy2.MorphAnalyzer(), maxsize=2)
+    for word in ('стало', 'стало', 'началом', 'хочет', 'стало'):
+        lemma_cache.get_lemma(word)
+
+    assert lemma_cache.get_lemma('стало') == 'стать'
+    stats = lemma_cache.as_dict()
+    assert (stats['hits'], stats['misses'], stats['size']) == (2, 4, 2)
+
+
+class ChargedWordsMatcher:
+    """Заряженные слова и фразы словаря, приведённые к нормальной форме и собранные в префиксное дерево.
+
+    Узлы дерева — словари {лемма: узел}, в узле, где кончается фраза, под ключом None лежит сама фраза.
+    Фразы в словаре короткие, так что поиск по статье линеен по её длине и не зависит от размера словаря.
+    version меняется вместе со словарём, по нему кэш результатов отличает старые оценки от новых.
+    """
+
+    def __init__(self, charged_words, lemma_cache):
+        self._trie = {}
+        terms = set()
+        for charged_word in charged_words:
+            lemmas = split_by_words_sync(lemma_cache, charged_word)
+            if not lemmas:
+                continue
+            node = self._trie
+            for lemma in lemmas:
+                node = node.setdefault(lemma, {})
+            node[None] = ' '.join(lemmas)
+            terms.add(node[None])
+
+        self.version = hashlib.sha1('\n'.join(sorted(terms)).encode()).hexdigest()[:12]
+
+    def _match(self, article_words, start):
+        node, term = self._trie, None
+        for position in range(start, len(article_words)):
+            node = node.get(article_words[position])
+            if node is None:
+                break
+            term = node.get(None, term)
+        return term
+
+    def count_terms(self, article_words):
+        """Считает, сколько раз в статье встретилась каждая заряженная фраза.
+
+        На каждом месте берётся самая длинная подходящая фраза, и следующая ищется сразу после неё,
+        так что одно слово статьи не попадёт в две фразы.
+        """
+        terms_counter = Counter()
+        position = 0
+        while position < len(article_words):
+            term = self._match(article_words, position)
+            if term:
+                terms_counter[term] += 1
+                position += term.count(' ') + 1
+            else:
+                position += 1
+        return terms_counter
 
 
 def calculate_jaundice_rate(article_words, charged_words):
-    """Расчитывает желтушность текста, принимает список "заряженных" слов и ищет их внутри article_words."""
+    """Расчитывает желтушность текста — долю слов article_words, попавших в заряженные слова и фразы.
+
+    Возвращает её вместе со счётчиком найденных фраз.
+    """
 
     if not article_words:
-        return 0.0
+        return 0.0, Counter()
 
-    found_charged_words = [word for word in article_words if word in set(charged_words)]
+    found_charged_words = charged_words.count_terms(article_words)
+    charged_words_count = sum(
+        (term.count(' ') + 1) * count for term, count in found_charged_words.items()
+    )
 
-    score = len(found_charged_words) / len(article_words) * 100
+    score = charged_words_count / len(article_words) * 100
 
-    return round(score, 2)
+    return round(score, 2), found_charged_words
 
 
 def test_calculate_jaundice_rate():
-    assert -0.01 < calculate_jaundice_rate([], []) < 0.01
-    assert 33.0 < calculate_jaundice_rate(['все', 'аутсайдер', 'побег'], ['аутсайдер', 'банкротство']) < 34.0
+    lemma_cache = LemmaCache(pymorphy2.MorphAnalyzer())
+    charged_words = ChargedWordsMatcher(['аутсайдер', 'банкротство'], lemma_cache)
+    score, _ = calculate_jaundice_rate([], charged_words)
+    assert -0.01 < score < 0.01
+    score, found_charged_words = calculate_jaundice_rate(['все', 'аутсайдер', 'побег'], charged_words)
+    assert 33.0 < score < 34.0
+    assert found_charged_words == {'аутсайдер': 1}
+
+
+def test_charged_words_matcher():
+    lemma_cache = LemmaCache(pymorphy2.MorphAnalyzer())
+    charged_words = ChargedWordsMatcher(['новый год', 'год', 'медовый месяц', 'Аутсайдеры', ''], lemma_cache)
+    article_words = split_by_words_sync(lemma_cache, 'Новый год аутсайдеров: год без медового отпуска, к новому году')
+
+    assert charged_words.count_terms(article_words) == {'новый год': 2, 'год': 1, 'аутсайдер': 1}
+    score, _ = calculate_jaundice_rate(article_words, charged_words)
+    assert score == round(6 / len(article_words) * 100, 2)
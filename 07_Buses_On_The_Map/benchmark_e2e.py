@@ -0,0 +1,216 @@
+import dataclasses
+import json
+import random
+from contextlib import AsyncExitStack
+
+import asyncclick as click
+import numpy as np
+import trio
+from trio_websocket import ConnectionClosed, open_websocket_url
+
+from benchmark_index import MOSCOW_BOUNDS, VIEWPORT_LAT_SIZE, VIEWPORT_LNG_SIZE
+from utils.decorators import suppress
+from utils.traffic import read_frames
+
+
+# Сколько ждать после конца записи, пока до браузеров дойдут последние координаты
+DRAIN_DELAY = 1
+
+
+@dataclasses.dataclass
+class BenchmarkStats:
+    frames_sent: int = 0
+    updates_sent: int = 0
+    messages_received: int = 0
+    bytes_received: int = 0
+    latencies: list = dataclasses.field(default_factory=list)
+
+
+def get_positions(message):
+    """Достаёт из сообщения имитатора (busId, lat, lng) всех автобусов, чтобы потом узнать их у браузеров."""
+    try:
+        data = json.loads(message)
+        buses = data['buses'] if 'buses' in data else [data]
+        return [(bus['busId'], bus['lat'], bus['lng']) for bus in buses]
+    except (ValueError, TypeError, KeyError):
+        return []
+
+
+def strip_timestamp(message):
+    """Убирает время отправки, проставленное имитатором при записи: иначе сервер считал бы задержку от записи."""
+    try:
+        data = json.loads(message)
+    except ValueError:
+        return message
+
+    if not isinstance(data, dict) or 'timestamp' not in data:
+        return message
+    del data['timestamp']
+    return json.dumps(data, ensure_ascii=False)
+
+
+def load_recording(path):
+    return [
+        (timestamp, connection, strip_timestamp(message), get_positions(message))
+        for timestamp, connection, message in read_frames(path)
+    ]
+
+
+async def replay(server, frames, speed, sent_at, stats):
+    """Отправляет записанные сообщения по стольким же соединениям, что были при записи.
+
+    speed — во сколько раз быстрее записи, 0 — без пауз, с той скоростью, что выдержит сервер.
+    """
+    connections_number = max((connection for _, connection, _, _ in frames), default=0) + 1
+    async with AsyncExitStack() as stack:
+        websockets = [
+            await stack.enter_async_context(open_websocket_url(server, ssl_context=None))
+            for _ in range(connections_number)
+        ]
+
+        started_at = trio.current_time()
+        for timestamp, connection, message, positions in frames:
+            if speed:
+                await trio.sleep_until(started_at + timestamp / speed)
+            now = trio.current_time()
+            for position in positions:
+                sent_at[position] = now
+            await websockets[connection].send_message(message)
+            stats.frames_sent += 1
+            stats.updates_sent += len(positions)
+
+
+async def pan_viewport(ws, rng, pan_interval):
+    """Двигает окно браузера на четверть его размера в случайную сторону, отражаясь от границ Москвы."""
+    south_lat = rng.uniform(MOSCOW_BOUNDS.south_lat, MOSCOW_BOUNDS.north_lat - VIEWPORT_LAT_SIZE)
+    west_lng = rng.uniform(MOSCOW_BOUNDS.west_lng, MOSCOW_BOUNDS.east_lng - VIEWPORT_LNG_SIZE)
+    lat_step = rng.choice((-1, 1)) * VIEWPORT_LAT_SIZE / 4
+    lng_step = rng.choice((-1, 1)) * VIEWPORT_LNG_SIZE / 4
+
+    while True:
+        await ws.send_message(json.dumps({
+            'msgType': 'newBounds',
+            'data': {
+                'south_lat': south_lat,
+                'north_lat': south_lat + VIEWPORT_LAT_SIZE,
+                'east_lng': west_lng + VIEWPORT_LNG_SIZE,
+                'west_lng': west_lng,
+            },
+        }))
+        await trio.sleep(pan_interval)
+
+        if not MOSCOW_BOUNDS.south_lat <= south_lat + lat_step <= MOSCOW_BOUNDS.north_lat - VIEWPORT_LAT_SIZE:
+            lat_step = -lat_step
+        if not MOSCOW_BOUNDS.west_lng <= west_lng + lng_step <= MOSCOW_BOUNDS.east_lng - VIEWPORT_LNG_SIZE:
+            lng_step = -lng_step
+        south_lat += lat_step
+        west_lng += lng_step
+
+
+@suppress(ConnectionClosed)
+async def run_viewer(address, rng, pan_interval, sent_at, stats):
+    """Браузер-робот: двигает окно по сценарию и замеряет, через сколько до него доходят новые координаты.
+
+    Задержку считаем только по сдвинувшимся автобусам: в полном списке и среди добавленных
+    бывают автобусы, которые давно стоят на месте.
+    """
+    async with open_websocket_url(address, ssl_context=None) as ws:
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(pan_viewport, ws, rng, pan_interval)
+            while True:
+                message = await ws.get_message()
+                now = trio.current_time()
+                stats.messages_received += 1
+                stats.bytes_received += len(message)
+
+                for bus in json.loads(message).get('moved', []):
+                    sent = sent_at.get((bus['busId'], bus['lat'], bus['lng']))
+                    if sent is not None:
+                        stats.latencies.append(now - sent)
+
+
+def print_report(stats, browsers, elapsed):
+    click.echo(
+        f'Sent {stats.frames_sent} frames, {stats.updates_sent} updates in {elapsed:.1f} s: '
+        f'{stats.frames_sent / elapsed:.0f} frames/s, {stats.updates_sent / elapsed:.0f} updates/s'
+    )
+    if not browsers:
+        return
+
+    click.echo(
+        f'Browsers received {stats.messages_received / elapsed:.0f} msgs/s, '
+        f'{stats.bytes_received / elapsed / browsers / 1024:.1f} KB/s per browser'
+    )
+    if stats.latencies:
+        p50, p90, p99 = np.percentile(stats.latencies, [50, 90, 99]) * 1000
+        click.echo(
+            f'Latency, ms: p50 {p50:.0f}, p90 {p90:.0f}, p99 {p99:.0f}, max {max(stats.latencies) * 1000:.0f} '
+            f'({len(stats.latencies)} samples)'
+        )
+
+
+@click.command()
+@click.option(
+    '--recording',
+    default='',
+    help='Файл, записанный record_traffic.py. Без него работают только браузеры, а координаты шлёт fake_bus.py',
+)
+@click.option(
+    '--speed',
+    default=1.0,
+    help='Во сколько раз быстрее записи воспроизводить сообщения, 0 — без пауз',
+)
+@click.option(
+    '--bus-server',
+    default='ws://127.0.0.1:8080',
+    help='Адрес сервера для автобусов',
+)
+@click.option(
+    '--browser-server',
+    default='ws://127.0.0.1:8000',
+    help='Адрес сервера для браузеров',
+)
+@click.option(
+    '--browsers',
+    default=10,
+    help='Сколько браузеров открыть',
+)
+@click.option(
+    '--pan-interval',
+    default=2.0,
+    help='Как часто браузер двигает окно, в секундах',
+)
+@click.option(
+    '--duration',
+    default=30.0,
+    help='Сколько секунд длится замер, если запись не закончится раньше',
+)
+@click.option(
+    '--seed',
+    default=0,
+    help='Зерно для сценариев движения окон, чтобы запуски повторялись',
+)
+async def main(recording, speed, bus_server, browser_server, browsers, pan_interval, duration, seed):
+    frames = load_recording(recording) if recording else []
+    stats = BenchmarkStats()
+    sent_at = {}
+
+    started_at = trio.current_time()
+    async with trio.open_nursery() as nursery:
+        for browser_index in range(browsers):
+            rng = random.Random(f'{seed}-{browser_index}')
+            nursery.start_soon(run_viewer, browser_server, rng, pan_interval, sent_at, stats)
+
+        with trio.move_on_after(duration):
+            if frames:
+                await replay(bus_server, frames, speed, sent_at, stats)
+                await trio.sleep(DRAIN_DELAY)
+            else:
+                await trio.sleep_forever()
+        nursery.cancel_scope.cancel()
+
+    print_report(stats, browsers, trio.current_time() - started_at)
+
+
+if __name__ == '__main__':
+    main(_anyio_backend='trio')
@@ -0,0 +1,144 @@
+import random
+import tracemalloc
+from timeit import repeat, timeit
+
+import asyncclick as click
+import numpy as np
+
+from bus_store import BusStore
+from models import Bus, WindowBounds
+
+
+# Москва в пределах МКАД с запасом и окно браузера на 14-м зуме
+MOSCOW_BOUNDS = WindowBounds(south_lat=55.55, north_lat=55.95, east_lng=37.90, west_lng=37.35)
+VIEWPORT_LAT_SIZE = 0.047
+VIEWPORT_LNG_SIZE = 0.111
+REPEATS = 5
+
+
+def generate_buses(buses_number):
+    for bus_index in range(buses_number):
+        yield Bus(
+            busId=str(bus_index),
+            lat=random.uniform(MOSCOW_BOUNDS.south_lat, MOSCOW_BOUNDS.north_lat),
+            lng=random.uniform(MOSCOW_BOUNDS.west_lng, MOSCOW_BOUNDS.east_lng),
+            route=str(bus_index % 595),
+        )
+
+
+def generate_viewports(viewports_number):
+    viewports = []
+    for _ in range(viewports_number):
+        south_lat = random.uniform(MOSCOW_BOUNDS.south_lat, MOSCOW_BOUNDS.north_lat - VIEWPORT_LAT_SIZE)
+        west_lng = random.uniform(MOSCOW_BOUNDS.west_lng, MOSCOW_BOUNDS.east_lng - VIEWPORT_LNG_SIZE)
+        viewports.append(
+            WindowBounds(
+                south_lat=south_lat,
+                north_lat=south_lat + VIEWPORT_LAT_SIZE,
+                east_lng=west_lng + VIEWPORT_LNG_SIZE,
+                west_lng=west_lng,
+            )
+        )
+    return viewports
+
+
+def find_linear(buses, bounds):
+    return {bus.busId: (bus.lat, bus.lng, bus.route) for bus in buses.values() if bus.is_inside(bounds)}
+
+
+def find_scan(columns, bounds):
+    """Сравнения numpy по всем строкам колонок хранилища, без сетки."""
+    bus_ids, routes, lats, lngs = columns
+    lats, lngs = np.frombuffer(lats), np.frombuffer(lngs)
+    slots = np.flatnonzero(
+        (lats > bounds.south_lat) & (lats < bounds.north_lat)
+        & (lngs > bounds.west_lng) & (lngs < bounds.east_lng)
+    )
+    return {
+        bus_ids[slot]: (lat, lng, routes[slot])
+        for slot, lat, lng in zip(slots.tolist(), lats[slots].tolist(), lngs[slots].tolist())
+    }
+
+
+def find_grid(store, bounds):
+    return store.find_inside(bounds)
+
+
+def measure_memory(build):
+    tracemalloc.start()
+    result = build()
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, memory
+
+
+def measure_time(find, index, viewports):
+    """Лучшее из нескольких повторов: на общей машине отдельный прогон легко замедляют соседи."""
+    return min(repeat(lambda: [find(index, bounds) for bounds in viewports], number=1, repeat=REPEATS))
+
+
+def build_dict(buses_number):
+    return {bus.busId: bus for bus in generate_buses(buses_number)}
+
+
+def build_store(buses_number, cell_size):
+    store = BusStore(cell_size)
+    for bus in generate_buses(buses_number):
+        store.update(bus)
+    return store
+
+
+@click.command()
+@click.option(
+    '--buses-number',
+    '-n',
+    multiple=True,
+    type=int,
+    default=[10_000, 50_000, 200_000],
+    help='Количество автобусов, можно указать несколько раз',
+)
+@click.option(
+    '--viewports-number',
+    default=20,
+    help='Количество окон браузера, по которым ищем автобусы',
+)
+@click.option(
+    '--cell-size',
+    default=0.01,
+    help='Размер ячейки сетки в градусах',
+)
+def main(buses_number, viewports_number, cell_size):
+    random.seed(0)
+    viewports = generate_viewports(viewports_number)
+
+    click.echo(
+        f'{"buses":>8} {"dict, B/bus":>12} {"store, B/bus":>13} '
+        f'{"linear, ms":>11} {"scan, ms":>9} {"grid, ms":>9} {"speedup":>8} {"update, us":>11}'
+    )
+    for number in buses_number:
+        random.seed(number)
+        buses, dict_memory = measure_memory(lambda: build_dict(number))
+        random.seed(number)
+        store, store_memory = measure_memory(lambda: build_store(number, cell_size))
+        columns = store.get_columns()
+
+        for bounds in viewports:
+            assert find_linear(buses, bounds) == find_scan(columns, bounds) == find_grid(store, bounds)
+
+        linear_time = measure_time(find_linear, buses, viewports)
+        scan_time = measure_time(find_scan, columns, viewports)
+        grid_time = measure_time(find_grid, store, viewports)
+        update_time = timeit(lambda: [store.update(bus) for bus in buses.values()], number=1)
+
+        click.echo(
+            f'{number:>8} {dict_memory / number:>12.0f} {store_memory / number:>13.0f} '
+            f'{linear_time / viewports_number * 1000:>11.3f} '
+            f'{scan_time / viewports_number * 1000:>9.3f} '
+            f'{grid_time / viewports_number * 1000:>9.3f} '
+            f'{linear_time / grid_time:>7.1f}x '
+            f'{update_time / number * 1_000_000:>11.3f}'
+        )
+
+
+if __name__ == '__main__':
+    main(_anyio_backend='trio')
@@ -0,0 +1,53 @@
+import json
+from timeit import timeit
+
+import asyncclick as click
+
+from models import Bus
+from serializers import BusSerializer, parse_buses, parse_buses_fast
+
+
+def parse_bus_pydantic(message):
+    bus = BusSerializer.parse_raw(message).dict()
+    return [Bus(**bus)], None
+
+
+def generate_messages(messages_number, batch_size):
+    messages = []
+    for message_index in range(messages_number):
+        buses = [
+            {'busId': f'{message_index}-{bus_index}', 'lat': 55.75 + bus_index / 1000, 'lng': 37.6, 'route': '120'}
+            for bus_index in range(batch_size)
+        ]
+        message = buses[0] if batch_size == 1 else {'msgType': 'Buses', 'buses': buses}
+        messages.append(json.dumps(message, ensure_ascii=False))
+    return messages
+
+
+@click.command()
+@click.option(
+    '--messages-number',
+    default=20_000,
+    help='Количество сообщений',
+)
+def main(messages_number):
+    parsers = {
+        'BusSerializer.parse_raw': parse_bus_pydantic,
+        'parse_buses': parse_buses,
+        'parse_buses_fast': parse_buses_fast,
+    }
+
+    click.echo(f'{"parser":>24} {"batch":>6} {"updates/s":>11}')
+    for batch_size in (1, 100):
+        messages = generate_messages(messages_number // batch_size, batch_size)
+        for name, parse in parsers.items():
+            if batch_size > 1 and parse is parse_bus_pydantic:
+                continue
+
+            assert parse(messages[0]) == parse_buses(messages[0])
+            parse_time = timeit(lambda: [parse(message) for message in messages], number=1)
+            click.echo(f'{name:>24} {batch_size:>6} {len(messages) * batch_size / parse_time:>11.0f}')
+
+
+if __name__ == '__main__':
+    main(_anyio_backend='trio')
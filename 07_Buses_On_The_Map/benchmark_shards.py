@@ -0,0 +1,103 @@
+import json
+import random
+import time
+from timeit import repeat
+
+import asyncclick as click
+
+import server
+from benchmark_index import MOSCOW_BOUNDS, generate_buses
+from models import Bus
+from serializers import parse_buses_fast
+from shards import collect_updates, pack_batch, unpack_batch
+
+
+REPEATS = 5
+
+
+def generate_moves(buses, batches_number, batch_size):
+    """Пачки сдвигов уже известных автобусов, busId в пачке не повторяются."""
+    return [
+        [
+            Bus(bus.busId, bus.lat + random.uniform(-1e-4, 1e-4), bus.lng + random.uniform(-1e-4, 1e-4), bus.route)
+            for bus in random.sample(buses, batch_size)
+        ]
+        for _ in range(batches_number)
+    ]
+
+
+def measure_rate(run, updates_number):
+    """Лучшее из нескольких повторов: на общей машине отдельный прогон легко замедляют соседи."""
+    return updates_number / min(repeat(run, number=1, repeat=REPEATS))
+
+
+def run_worker(messages):
+    updates = {}
+    for message in messages:
+        collect_updates(updates, *parse_buses_fast(message))
+    return pack_batch(*zip(*updates.values()))
+
+
+def run_json_coordinator(batches):
+    for batch in batches:
+        server.store_buses([Bus(*bus) for bus in json.loads(batch)])
+
+
+def run_batch_coordinator(batches):
+    for batch in batches:
+        server.store_batch(*unpack_batch(batch))
+
+
+@click.command()
+@click.option(
+    '--buses-number',
+    default=20_000,
+    help='Сколько автобусов уже на карте',
+)
+@click.option(
+    '--batch-size',
+    default=1000,
+    help='Сколько автобусов воркер присылает координатору за раз',
+)
+@click.option(
+    '--batches-number',
+    default=20,
+    help='Сколько пачек применить за один прогон',
+)
+async def main(buses_number, batch_size, batches_number):
+    """Сравнивает, сколько координат в секунду разбирает один воркер и сколько применяет координатор.
+
+    Воркеры работают параллельно, а координатор один, поэтому воркеров имеет смысл добавлять,
+    пока их общая скорость меньше скорости координатора.
+    """
+    random.seed(0)
+    buses = list(generate_buses(buses_number))
+    server.store_buses(buses)
+    moves = generate_moves(buses, batches_number, batch_size)
+    updates_number = batches_number * batch_size
+
+    messages = [
+        json.dumps({'msgType': 'Buses', 'buses': [
+            {'busId': bus.busId, 'lat': bus.lat, 'lng': bus.lng, 'route': bus.route} for bus in batch[offset:offset + 100]
+        ]})
+        for batch in moves
+        for offset in range(0, batch_size, 100)
+    ]
+    json_batches = [json.dumps([(bus.busId, bus.lat, bus.lng, bus.route) for bus in batch]).encode() for batch in moves]
+    binary_batches = [pack_batch(batch, [time.time()] * len(batch)) for batch in moves]
+
+    worker_rate = measure_rate(lambda: run_worker(messages), updates_number)
+    rates = {
+        'worker: parse_buses_fast + pack_batch': worker_rate,
+        'coordinator: JSON + store_buses': measure_rate(lambda: run_json_coordinator(json_batches), updates_number),
+        'coordinator: unpack_batch + store_batch': measure_rate(lambda: run_batch_coordinator(binary_batches), updates_number),
+    }
+
+    click.echo(f'Автобусов на карте: {buses_number}, в пачке: {batch_size}, окно Москвы {MOSCOW_BOUNDS}')
+    click.echo(f'{"":>40} {"updates/s":>11} {"workers":>8}')
+    for name, rate in rates.items():
+        click.echo(f'{name:>40} {rate:>11.0f} {rate / worker_rate:>8.1f}')
+
+
+if __name__ == '__main__':
+    main(_anyio_backend='trio')
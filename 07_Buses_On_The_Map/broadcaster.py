@@ -0,0 +1,150 @@
+import dataclasses
+import logging
+import time
+
+import numpy as np
+import trio
+
+from messages import ENCODERS, make_snapshot, make_delta, make_clusters
+from metrics import Histogram
+
+
+CLUSTER_THRESHOLD = 300
+COALESCE_WINDOW = 0.1
+MAX_RATE = 5
+logger = logging.getLogger('server')
+
+
+class Broadcaster:
+    """Собирает сообщения для браузеров, в окне которых что-то изменилось.
+
+    Рассылка просыпается от первого изменения и ещё coalesce_window собирает следующие, чтобы
+    отправить их одним сообщением. Браузер получает не больше max_rate сообщений в секунду,
+    остальные изменения дождутся его очереди. Изменившиеся автобусы сериализуются один раз
+    за рассылку. Автобусы в ячейках сетки под окном собираются один раз на все браузеры с теми же
+    ячейками, а каждый браузер отсекает из них numpy то, что не попало в его окно. Браузеры, у которых
+    после этого совпали автобусы в окне и уже полученное состояние, получают одно готовое сообщение.
+    """
+
+    def __init__(
+        self, buses, sessions, clusters, cluster_threshold=CLUSTER_THRESHOLD,
+        coalesce_window=COALESCE_WINDOW, max_rate=MAX_RATE, fanout_time=None
+    ):
+        self.buses = buses
+        self.sessions = sessions
+        self.clusters = clusters
+        self.cluster_threshold = cluster_threshold
+        self.coalesce_window = coalesce_window
+        self.max_rate = max_rate
+        self.fanout_time = fanout_time or Histogram()
+        self.encoders = {encoding: encoder() for encoding, encoder in ENCODERS.items()}
+        self._changed_buses = set()
+
+    def notify(self, bus_id, *cells, changed_at=None):
+        self._changed_buses.add(bus_id)
+        self.sessions.notify(*cells, changed_at=changed_at)
+
+    def notify_many(self, bus_ids, cells, changed_at=None):
+        self._changed_buses.update(bus_ids)
+        self.sessions.notify(*cells, changed_at=changed_at)
+
+    def prepare_clusters(self, bounds):
+        """Возвращает кластеры, если автобусов в окне больше порога, иначе None."""
+        if bounds.zoom is None or bounds.is_null():
+            return
+
+        clusters = self.clusters.find_clusters(bounds, bounds.zoom)
+        if sum(count for _, _, count in clusters) > self.cluster_threshold:
+            return clusters
+
+    def select_inside(self, bounds, cells_slots):
+        """Возвращает упорядоченные номера строк BusStore с автобусами в окне.
+
+        cells_slots запоминает строки из ячеек уже встречавшихся в этой рассылке диапазонов.
+        """
+        if bounds.is_null():
+            return np.empty(0, dtype=np.int64)
+
+        cell_range = self.buses.index.get_cell_range(bounds)
+        slots = cells_slots.get(cell_range)
+        if slots is None:
+            slots = cells_slots[cell_range] = self.buses.select_cells(cell_range)
+        return np.sort(self.buses.select_inside(slots, bounds))
+
+    def prepare_message(self, session, is_snapshot, cells_slots, prepared):
+        clusters_key = ('clusters', dataclasses.astuple(session.bounds))
+        if clusters_key not in prepared:
+            clusters = self.prepare_clusters(session.bounds)
+            prepared[clusters_key] = make_clusters(clusters) if clusters is not None else None
+        if prepared[clusters_key] is not None:
+            # Кластеры заменяют маркеры автобусов, так что после них браузер не видит ни одного автобуса
+            return prepared[clusters_key], {}
+
+        slots = self.select_inside(session.bounds, cells_slots)
+        logger.debug(f'{len(slots)} buses inside bounds of session {session.session_id}')
+
+        # Изменения считаются от того, что браузер уже забрал, поэтому общие они только при том же visible
+        visible_id = None if is_snapshot else id(session.visible)
+        key = ('buses', session.encoding, is_snapshot, visible_id, slots.tobytes())
+        if key not in prepared:
+            buses_inside = self.buses.get_rows(slots)
+            if is_snapshot:
+                message = make_snapshot(buses_inside, self.encoders[session.encoding])
+            else:
+                message = make_delta(session.visible, buses_inside, self.encoders[session.encoding])
+            prepared[key] = message, buses_inside
+
+        return prepared[key]
+
+    def broadcast(self, now):
+        """Рассылает сообщения браузерам, чья очередь подошла, и возвращает, когда подойдёт очередь остальных."""
+        for encoder in self.encoders.values():
+            encoder.invalidate(self._changed_buses)
+        self._changed_buses.clear()
+
+        send_interval = 1 / self.max_rate if self.max_rate else 0
+        next_send_at = None
+
+        # Сообщение считается от того, что браузер уже забрал, поэтому неотправленное можно просто вытеснить
+        cells_slots, prepared = {}, {}
+        for session in list(self.sessions.dirty):
+            if session.next_send_at > now:
+                if next_send_at is None or session.next_send_at < next_send_at:
+                    next_send_at = session.next_send_at
+                continue
+
+            is_snapshot = session.needs_snapshot or session.mailbox.has_snapshot
+            self.sessions.dirty.discard(session)
+            try:
+                message, visible = self.prepare_message(session, is_snapshot, cells_slots, prepared)
+            except Exception:
+                # Ошибка одного сообщения не должна останавливать рассылку остальным браузерам
+                logger.exception(f'Failed to prepare message for session {session.session_id}')
+                continue
+
+            changed_at = session.changed_at
+            session.needs_snapshot = False
+            session.changed_at = None
+
+            if message or len(session.mailbox):
+                session.mailbox.put(message, visible, is_snapshot, changed_at)
+                session.next_send_at = now + send_interval
+
+        return next_send_at
+
+    def measured_broadcast(self):
+        started_at = time.perf_counter()
+        next_send_at = self.broadcast(trio.current_time())
+        self.fanout_time.observe(time.perf_counter() - started_at)
+        return next_send_at
+
+    async def run(self):
+        while True:
+            await self.sessions.wait_dirty()
+            await trio.sleep(self.coalesce_window)
+            next_send_at = self.measured_broadcast()
+
+            # Браузеры, которым было рано, копили изменения с прошлой отправки: ждать ещё окно им незачем
+            while next_send_at is not None:
+                await trio.sleep_until(next_send_at)
+                next_send_at = self.measured_broadcast()
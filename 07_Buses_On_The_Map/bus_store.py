@@ -0,0 +1,179 @@
+from array import array
+from itertools import repeat
+
+import numpy as np
+
+from models import Bus
+from spatial_index import CELL_SIZE, SLOT_TYPECODE, GridIndex
+
+
+def column_view(column):
+    """Возвращает представление numpy над колонкой array без копирования.
+
+    Пока представление живо, array не может расти (BufferError), поэтому его не сохраняют в переменных,
+    а сразу читают или меняют через take_rows, put_rows и add_rows.
+    """
+    return np.frombuffer(column, dtype=column.typecode)
+
+
+def take_rows(column, rows):
+    """Возвращает копию значений колонки в строках rows."""
+    return column_view(column)[rows]
+
+
+def put_rows(column, rows, values):
+    column_view(column)[rows] = values
+
+
+def add_rows(column, rows, values):
+    """Прибавляет values к строкам rows, строки в rows не должны повторяться."""
+    column_view(column)[rows] += values
+
+
+class BusStore:
+    """Хранит автобусы по колонкам: координаты лежат в массивах array('d'), а busId -> номер строки в словаре.
+
+    Маршрутов на порядки меньше, чем автобусов, поэтому одинаковые строки маршрутов хранятся одним объектом.
+    Строки идут без дыр: на место удалённого автобуса переезжает последний. Строки разложены по
+    ячейкам сетки index, так что поиск в окне берёт целиком ячейки внутри окна, а сравнения numpy
+    делает только для строк из ячеек на его краю.
+    """
+
+    def __init__(self, cell_size=CELL_SIZE):
+        self.index = GridIndex(cell_size)
+        self._slots = {}
+        self._bus_ids = []
+        self._routes = []
+        self._route_names = {}
+        self._lats = array('d')
+        self._lngs = array('d')
+
+    def __len__(self):
+        return len(self._bus_ids)
+
+    def __contains__(self, bus_id):
+        return bus_id in self._slots
+
+    def __iter__(self):
+        return map(self._get_by_slot, range(len(self)))
+
+    def _intern_route(self, route):
+        return self._route_names.setdefault(route, route)
+
+    def update(self, bus):
+        """Возвращает прежние координаты автобуса (None, если автобус новый), его прежнюю и новую ячейки."""
+        slot = self._slots.get(bus.busId)
+        if slot is None:
+            self._slots[bus.busId] = len(self._bus_ids)
+            self._bus_ids.append(bus.busId)
+            self._routes.append(self._intern_route(bus.route))
+            self._lats.append(bus.lat)
+            self._lngs.append(bus.lng)
+            return None, None, self.index.add(bus.lat, bus.lng)
+
+        old_position = self._lats[slot], self._lngs[slot]
+        self._routes[slot] = self._intern_route(bus.route)
+        self._lats[slot] = bus.lat
+        self._lngs[slot] = bus.lng
+        return (old_position, *self.index.move(slot, bus.lat, bus.lng))
+
+    def update_many(self, bus_ids, routes, lats, lngs):
+        """Обновляет сразу много автобусов, busId в пачке не должны повторяться.
+
+        Координаты известных автобусов меняются присваиваниями numpy, новые добавляются по одному.
+        Возвращает прежние координаты (NaN для новых автобусов) и множество ячеек, где что-то поменялось.
+        """
+        slots = np.array(list(map(self._slots.get, bus_ids, repeat(-1))), dtype=np.int64)
+        known = np.flatnonzero(slots >= 0)
+        known_slots = slots[known]
+
+        old_lats, old_lngs = np.full(len(slots), np.nan), np.full(len(slots), np.nan)
+        old_lats[known], old_lngs[known] = take_rows(self._lats, known_slots), take_rows(self._lngs, known_slots)
+        put_rows(self._lats, known_slots, lats[known])
+        put_rows(self._lngs, known_slots, lngs[known])
+
+        for slot, index in zip(known_slots.tolist(), known.tolist()):
+            self._routes[slot] = self._intern_route(routes[index])
+        cells = self.index.move_many(known_slots, lats[known], lngs[known])
+
+        for index in np.flatnonzero(slots < 0).tolist():
+            _, _, cell = self.update(Bus(bus_ids[index], float(lats[index]), float(lngs[index]), routes[index]))
+            cells.add(cell)
+
+        return old_lats, old_lngs, cells
+
+    def remove(self, bus_id):
+        """Возвращает последние координаты и ячейку удалённого автобуса."""
+        slot = self._slots.pop(bus_id)
+        position = self._lats[slot], self._lngs[slot]
+        cell = self.index.remove(slot)
+        last_bus_id = self._bus_ids.pop()
+        last_route = self._routes.pop()
+        last_lat = self._lats.pop()
+        last_lng = self._lngs.pop()
+
+        if last_bus_id != bus_id:
+            self._slots[last_bus_id] = slot
+            self._bus_ids[slot] = last_bus_id
+            self._routes[slot] = last_route
+            self._lats[slot] = last_lat
+            self._lngs[slot] = last_lng
+
+        return position, cell
+
+    def load_columns(self, bus_ids, routes, lats, lngs):
+        """Заменяет всё содержимое готовыми колонками, например из снимка при запуске сервера."""
+        self._bus_ids = list(bus_ids)
+        self._route_names = {}
+        self._routes = list(map(self._intern_route, routes))
+        self._lats = array('d', lats)
+        self._lngs = array('d', lngs)
+        self._slots = {bus_id: slot for slot, bus_id in enumerate(self._bus_ids)}
+        self.index.load(self._lats, self._lngs)
+
+    def get_columns(self):
+        """Возвращает копии колонок (busIds, routes, lats, lngs), которые можно отдать в другой поток."""
+        return list(self._bus_ids), list(self._routes), array('d', self._lats), array('d', self._lngs)
+
+    def get(self, bus_id):
+        slot = self._slots.get(bus_id)
+        if slot is not None:
+            return self._get_by_slot(slot)
+
+    def _get_by_slot(self, slot):
+        return Bus(self._bus_ids[slot], self._lats[slot], self._lngs[slot], self._routes[slot])
+
+    def select_cells(self, cell_range):
+        """Возвращает номера строк всех автобусов в ячейках диапазона, не проверяя координаты."""
+        slots = array(SLOT_TYPECODE)
+        for cell_slots, _ in self.index.get_cells(cell_range):
+            slots.extend(cell_slots)
+        return column_view(slots)
+
+    def select_inside(self, slots, bounds):
+        """Оставляет из номеров строк slots только автобусы внутри окна."""
+        slots_lats, slots_lngs = take_rows(self._lats, slots), take_rows(self._lngs, slots)
+        return slots[
+            (slots_lats > bounds.south_lat) & (slots_lats < bounds.north_lat)
+            & (slots_lngs > bounds.west_lng) & (slots_lngs < bounds.east_lng)
+        ]
+
+    def get_rows(self, slots):
+        """Возвращает {busId: (lat, lng, route)} для строк slots."""
+        lats, lngs = take_rows(self._lats, slots).tolist(), take_rows(self._lngs, slots).tolist()
+        bus_ids, routes = self._bus_ids, self._routes
+        return {bus_ids[slot]: (lat, lng, routes[slot]) for slot, lat, lng in zip(slots.tolist(), lats, lngs)}
+
+    def find_inside(self, bounds):
+        """Возвращает {busId: (lat, lng, route)} для автобусов внутри окна."""
+        if bounds.is_null() or not self._bus_ids:
+            return {}
+
+        inner_slots, border_slots = array(SLOT_TYPECODE), array(SLOT_TYPECODE)
+        for cell_slots, is_inner in self.index.get_cells(self.index.get_cell_range(bounds)):
+            (inner_slots if is_inner else border_slots).extend(cell_slots)
+
+        border_slots = self.select_inside(column_view(border_slots), bounds)
+        # По порядку строк колонки читаются подряд, а не вразброс по памяти
+        slots = np.sort(np.concatenate((column_view(inner_slots), border_slots)))
+        return self.get_rows(slots)
@@ -0,0 +1,179 @@
+import math
+from array import array
+
+import numpy as np
+
+from bus_store import add_rows, column_view, put_rows, take_rows
+
+# Сетки кластеров от ~250 м до ~70 км, каждая следующая вдвое крупнее
+CLUSTER_CELL_SIZES = tuple(0.0025 * 2 ** level for level in range(9))
+# Примерный размер кластера на экране в пикселях
+CLUSTER_PIXEL_SIZE = 64
+TILE_SIZE = 256
+# Номера ячеек в ключе сдвинуты на CELL_OFFSET, чтобы быть неотрицательными и занимать CELL_BITS бит
+CELL_BITS = 24
+CELL_OFFSET = 2 ** (CELL_BITS - 1)
+CELL_MASK = 2 ** CELL_BITS - 1
+
+
+class ClusterIndex:
+    """Поддерживает для нескольких сеток число автобусов и сумму их координат в каждой ячейке.
+
+    Перемещение автобуса стоит несколько сложений на каждую сетку, а кластеры для окна —
+    это готовые ячейки подходящей сетки, без перебора автобусов.
+
+    Ячейки всех сеток лежат строками в общих колонках array: сетка, номер ячейки, число автобусов
+    и сумма координат. Строку ищут по ключу (сетка, широта, долгота), упакованному в одно число,
+    так что пачку перемещений numpy сводит в изменения ячеек всех сеток за один проход.
+    Строки опустевших ячеек остаются с нулевым числом автобусов: ячеек в городе немного.
+    """
+
+    def __init__(self, cell_sizes=CLUSTER_CELL_SIZES):
+        self.cell_sizes = cell_sizes
+        self._rows = {}
+        self._levels = array('q')
+        self._lat_cells = array('q')
+        self._lng_cells = array('q')
+        self._counts = array('q')
+        self._sum_lats = array('d')
+        self._sum_lngs = array('d')
+
+    @staticmethod
+    def get_cell(lat, lng, cell_size):
+        return math.floor(lat / cell_size), math.floor(lng / cell_size)
+
+    @staticmethod
+    def pack_key(level, lat_cell, lng_cell):
+        return (level << 2 * CELL_BITS) + ((lat_cell + CELL_OFFSET) << CELL_BITS) + lng_cell + CELL_OFFSET
+
+    def get_keys(self, lats, lngs):
+        """Возвращает ключи ячеек всех сеток для каждой точки, сетка за сеткой."""
+        cell_sizes = np.array(self.cell_sizes)[:, np.newaxis]
+        lat_cells = np.floor(lats / cell_sizes).astype(np.int64)
+        lng_cells = np.floor(lngs / cell_sizes).astype(np.int64)
+        levels = np.arange(len(self.cell_sizes), dtype=np.int64)[:, np.newaxis]
+        return self.pack_key(levels, lat_cells, lng_cells).ravel()
+
+    def _add_row(self, key):
+        row = self._rows[key] = len(self._counts)
+        self._levels.append(key >> 2 * CELL_BITS)
+        self._lat_cells.append((key >> CELL_BITS & CELL_MASK) - CELL_OFFSET)
+        self._lng_cells.append((key & CELL_MASK) - CELL_OFFSET)
+        self._counts.append(0)
+        self._sum_lats.append(0)
+        self._sum_lngs.append(0)
+        return row
+
+    def _change(self, lat, lng, sign):
+        for level, cell_size in enumerate(self.cell_sizes):
+            key = self.pack_key(level, *self.get_cell(lat, lng, cell_size))
+            row = self._rows.get(key)
+            if row is None:
+                row = self._add_row(key)
+
+            self._counts[row] += sign
+            if self._counts[row]:
+                self._sum_lats[row] += sign * lat
+                self._sum_lngs[row] += sign * lng
+            else:
+                self._sum_lats[row] = self._sum_lngs[row] = 0
+
+    def _change_many(self, keys, counts, delta_lats, delta_lngs):
+        """Сводит изменения по ключам ячеек numpy и применяет их к строкам ячеек."""
+        keys, inverse = np.unique(keys, return_inverse=True)
+        keys = keys.tolist()
+        rows = list(map(self._rows.get, keys))
+        if None in rows:
+            for index, row in enumerate(rows):
+                if row is None:
+                    rows[index] = self._add_row(keys[index])
+        rows = np.array(rows, dtype=np.int64)
+
+        # Строки в rows не повторяются, так что сложение по ним не теряет изменений
+        add_rows(self._counts, rows, np.bincount(inverse, weights=counts).round().astype(np.int64))
+        add_rows(self._sum_lats, rows, np.bincount(inverse, weights=delta_lats))
+        add_rows(self._sum_lngs, rows, np.bincount(inverse, weights=delta_lngs))
+        # В опустевших ячейках обнуляем суммы, чтобы в них не копились ошибки округления
+        empty_rows = rows[take_rows(self._counts, rows) == 0]
+        put_rows(self._sum_lats, empty_rows, 0)
+        put_rows(self._sum_lngs, empty_rows, 0)
+
+    def add(self, lat, lng):
+        self._change(lat, lng, 1)
+
+    def add_many(self, lats, lngs):
+        """Добавляет сразу много автобусов."""
+        lats, lngs = np.asarray(lats, dtype='f8'), np.asarray(lngs, dtype='f8')
+        if len(lats):
+            levels_number = len(self.cell_sizes)
+            self._change_many(
+                self.get_keys(lats, lngs), np.ones(levels_number * len(lats)),
+                np.tile(lats, levels_number), np.tile(lngs, levels_number),
+            )
+
+    def discard(self, lat, lng):
+        self._change(lat, lng, -1)
+
+    def move(self, old_position, lat, lng):
+        if old_position is not None:
+            self.discard(*old_position)
+        self.add(lat, lng)
+
+    def move_many(self, old_lats, old_lngs, lats, lngs):
+        """Передвигает сразу много автобусов. У новых автобусов в old_lats и old_lngs стоит NaN.
+
+        Автобус, оставшийся в своей ячейке, меняет в ней только суммы координат, а прежняя точка
+        вычитается отдельно только на тех сетках, где автобус сменил ячейку.
+        """
+        if not len(lats):
+            return
+
+        levels_number = len(self.cell_sizes)
+        keys = self.get_keys(lats, lngs)
+        counts = np.ones(len(keys))
+        delta_lats, delta_lngs = np.tile(lats, levels_number), np.tile(lngs, levels_number)
+
+        known = np.flatnonzero(~np.isnan(old_lats))
+        old_lats, old_lngs = np.tile(old_lats[known], levels_number), np.tile(old_lngs[known], levels_number)
+        # Точка known[i] на сетке level лежит в ключах под номером level * len(lats) + known[i]
+        known_points = (np.arange(levels_number)[:, np.newaxis] * len(lats) + known).ravel()
+        old_keys = self.get_keys(old_lats[:len(known)], old_lngs[:len(known)])
+        stayed = old_keys == keys[known_points]
+        moved = ~stayed
+
+        counts[known_points[stayed]] = 0
+        delta_lats[known_points[stayed]] -= old_lats[stayed]
+        delta_lngs[known_points[stayed]] -= old_lngs[stayed]
+
+        self._change_many(
+            np.concatenate((keys, old_keys[moved])),
+            np.concatenate((counts, np.full(np.count_nonzero(moved), -1.0))),
+            np.concatenate((delta_lats, -old_lats[moved])),
+            np.concatenate((delta_lngs, -old_lngs[moved])),
+        )
+
+    def get_level(self, zoom):
+        """Выбирает самую мелкую сетку, ячейка которой на этом зуме не меньше CLUSTER_PIXEL_SIZE."""
+        target_size = CLUSTER_PIXEL_SIZE * 360 / (TILE_SIZE * 2 ** zoom)
+        for level, cell_size in enumerate(self.cell_sizes):
+            if cell_size >= target_size:
+                return level
+        return len(self.cell_sizes) - 1
+
+    def find_clusters(self, bounds, zoom):
+        """Возвращает [(lat, lng, count)] для ячеек, пересекающих окно: центр масс и число автобусов."""
+        level = self.get_level(zoom)
+        cell_size = self.cell_sizes[level]
+        south, west = self.get_cell(bounds.south_lat, bounds.west_lng, cell_size)
+        north, east = self.get_cell(bounds.north_lat, bounds.east_lng, cell_size)
+
+        rows = np.flatnonzero(
+            (column_view(self._levels) == level) & (column_view(self._counts) > 0)
+            & (column_view(self._lat_cells) >= south) & (column_view(self._lat_cells) <= north)
+            & (column_view(self._lng_cells) >= west) & (column_view(self._lng_cells) <= east)
+        )
+        counts = take_rows(self._counts, rows)
+        lats = take_rows(self._sum_lats, rows) / counts
+        lngs = take_rows(self._sum_lngs, rows) / counts
+
+        return list(zip(lats.tolist(), lngs.tolist(), counts.tolist()))
@@ -0,0 +1,41 @@
+from collections import OrderedDict
+
+
+BUS_TTL = 30
+
+
+class LastSeen:
+    """Помнит, когда автобус последний раз присылал координаты, в порядке от самого давнего."""
+
+    def __init__(self, ttl=BUS_TTL):
+        self.ttl = ttl
+        self._last_seen = OrderedDict()
+
+    def __len__(self):
+        return len(self._last_seen)
+
+    def touch(self, bus_id, now):
+        self._last_seen[bus_id] = now
+        self._last_seen.move_to_end(bus_id)
+
+    def touch_many(self, bus_ids, now):
+        # Удалённые busId добавятся заново уже в конец, так что move_to_end по одному не нужен
+        pop = self._last_seen.pop
+        for bus_id in bus_ids:
+            pop(bus_id, None)
+        self._last_seen.update(dict.fromkeys(bus_ids, now))
+
+    def get(self, bus_id, default=None):
+        return self._last_seen.get(bus_id, default)
+
+    def discard(self, bus_id):
+        self._last_seen.pop(bus_id, None)
+
+    def pop_expired(self, now):
+        deadline = now - self.ttl
+        while self._last_seen:
+            bus_id, last_seen = next(iter(self._last_seen.items()))
+            if last_seen > deadline:
+                return
+            del self._last_seen[bus_id]
+            yield bus_id
@@ -1,18 +1,24 @@
+import dataclasses
+import itertools
 import json
 import logging
+import multiprocessing
 import random
 import sys
+import time
 
 import asyncclick as click
 import trio
 from trio_websocket import open_websocket_url
 
 from utils.decorators import suppress, relaunch_on_disconnect
-from utils.routes import load_routes
+from utils.routes import ROUTES_CACHE_PATH, load_catalogue, load_compiled_routes, load_routes
 from utils.setup import setup_logger
 
 
 RELAUNCH_DELAY = 3
+REPORT_INTERVAL = 5
+STATS_PUBLISH_DELAY = 0.5
 logger = logging.getLogger('fake_bus')
 
 
@@ -23,6 +29,19 @@ def generate_bus_id(emulator_id, route_id, bus_index):
     return bus_id
 
 
+def generate_worker_id(emulator_id, worker_index):
+    worker_id = f'w{worker_index}'
+    if emulator_id:
+        worker_id = f'{emulator_id}-{worker_id}'
+    return worker_id
+
+
+@dataclasses.dataclass
+class LoadStats:
+    messages: int = 0
+    updates: int = 0
+
+
 async def run_bus(send_channel, bus_id, route, start_offset, refresh_timeout):
     async with send_channel:
         route = route[start_offset:] + route[:start_offset]
@@ -30,16 +49,236 @@ async def run_bus(send_channel, bus_id, route, start_offset, refresh_timeout):
             for coordinates in route:
                 lat, lng = coordinates
                 message = {'busId': bus_id, 'lat': lat, 'lng': lng, 'route': bus_id}
-                await send_channel.send(json.dumps(message, ensure_ascii=False))
+                await send_channel.send(message)
                 await trio.sleep(refresh_timeout)
 
 
+async def collect_batch(message, receive_channel, batch_size, batch_timeout):
+    batch = [message]
+    with trio.move_on_after(batch_timeout):
+        while len(batch) < batch_size:
+            batch.append(await receive_channel.receive())
+    return {'msgType': 'Buses', 'buses': batch}
+
+
 @relaunch_on_disconnect(logger=logger, delay=RELAUNCH_DELAY)
-async def send_updates(server_address, receive_channel):
+async def send_updates(server_address, receive_channel, stats, batch_size=1, batch_timeout=0):
     async with open_websocket_url(server_address, ssl_context=None) as ws:
         async with receive_channel:
             async for message in receive_channel:
+                updates_number = 1
+                if batch_size > 1:
+                    message = await collect_batch(message, receive_channel, batch_size, batch_timeout)
+                    updates_number = len(message['buses'])
+                # По времени отправки сервер считает задержку до браузера, не завися от своих очередей
+                message['timestamp'] = time.time()
+                await ws.send_message(json.dumps(message, ensure_ascii=False))
+                stats.messages += 1
+                stats.updates += updates_number
+
+
+async def run_buses(
+    server, routes, buses_per_route, websockets_number, emulator_id,
+    refresh_timeout, buffer_size, batch_size, batch_timeout, stats
+):
+    async with trio.open_nursery() as nursery:
+        channels = [trio.open_memory_channel(buffer_size) for _ in range(websockets_number)]
+        for channel in channels:
+            receive_channel = channel[1]
+            nursery.start_soon(send_updates, server, receive_channel, stats, batch_size, batch_timeout)
+
+        for route in routes:
+            for bus_index in range(buses_per_route):
+                send_channel = random.choice(channels)[0]
+                bus_id = generate_bus_id(emulator_id, route['name'], bus_index)
+                start_offset = random.randrange(len(route['coordinates']))
+                nursery.start_soon(
+                    run_bus,
+                    send_channel,
+                    bus_id,
+                    route['coordinates'],
+                    start_offset,
+                    refresh_timeout
+                )
+
+
+@dataclasses.dataclass
+class EmulatedBus:
+    """Автобус генератора нагрузки: готовые куски JSON, которые остаётся только склеить."""
+
+    __slots__ = ('prefix', 'points', 'suffix', 'position')
+
+    prefix: str
+    points: list
+    suffix: str
+    position: int
+
+    def next_message(self):
+        point = self.points[self.position]
+        self.position += 1
+        if self.position == len(self.points):
+            self.position = 0
+        return self.prefix + point + self.suffix
+
+
+def prepare_emulated_buses(routes, buses_per_route, emulator_id):
+    """Кодирует координаты каждого маршрута в JSON один раз, а не на каждом шаге каждого автобуса."""
+    buses = []
+    for route in routes:
+        points = [f'"lat": {lat!r}, "lng": {lng!r}' for lat, lng in route['coordinates'].tolist()]
+        for bus_index in range(buses_per_route):
+            bus_id = json.dumps(generate_bus_id(emulator_id, route['name'], bus_index), ensure_ascii=False)
+            buses.append(
+                EmulatedBus(
+                    prefix=f'{{"busId": {bus_id}, ',
+                    points=points,
+                    suffix=f', "route": {bus_id}}}',
+                    position=random.randrange(len(points)),
+                )
+            )
+    return buses
+
+
+@relaunch_on_disconnect(logger=logger, delay=RELAUNCH_DELAY)
+async def generate_load(server_address, buses, refresh_timeout, batch_size, stats):
+    """Раз в refresh_timeout отправляет новые координаты всех своих автобусов, а если не успевает — без пауз."""
+    async with open_websocket_url(server_address, ssl_context=None) as ws:
+        while True:
+            deadline = trio.current_time() + refresh_timeout
+            for start in range(0, len(buses), batch_size):
+                messages = [bus.next_message() for bus in buses[start:start + batch_size]]
+                timestamp = time.time()
+                if batch_size > 1:
+                    message = f'{{"msgType": "Buses", "timestamp": {timestamp!r}, "buses": [{", ".join(messages)}]}}'
+                else:
+                    message = f'{messages[0][:-1]}, "timestamp": {timestamp!r}}}'
                 await ws.send_message(message)
+                stats.messages += 1
+                stats.updates += len(messages)
+            await trio.sleep_until(deadline)
+
+
+async def report_load(stats, report_interval):
+    previous_messages, previous_updates = 0, 0
+    previous_time = trio.current_time()
+    while True:
+        await trio.sleep(report_interval)
+        now = trio.current_time()
+        elapsed = now - previous_time
+        logger.info(
+            f'{(stats.messages - previous_messages) / elapsed:.0f} msgs/s, '
+            f'{(stats.updates - previous_updates) / elapsed:.0f} updates/s'
+        )
+        previous_messages, previous_updates, previous_time = stats.messages, stats.updates, now
+
+
+async def run_load_test(
+    server, routes, buses_per_route, websockets_number, emulator_id,
+    refresh_timeout, batch_size, stats
+):
+    buses = prepare_emulated_buses(routes, buses_per_route, emulator_id)
+    random.shuffle(buses)
+    logger.info(f'Prepared {len(buses)} buses')
+
+    async with trio.open_nursery() as nursery:
+        for ws_index in range(websockets_number):
+            nursery.start_soon(
+                generate_load,
+                server,
+                buses[ws_index::websockets_number],
+                refresh_timeout,
+                batch_size,
+                stats,
+            )
+
+
+async def run_emulator(
+    server, routes_number, buses_per_route, websockets_number, emulator_id, refresh_timeout,
+    buffer_size, batch_size, batch_timeout, directory_path, load_test, cache_path,
+    stats, worker_index=0, workers_number=1
+):
+    """Запускает автобусы своей доли маршрутов: каждый workers_number-й, начиная с worker_index."""
+    if load_test:
+        routes = load_compiled_routes(directory_path, routes_number, cache_path)
+    else:
+        routes = load_routes(directory_path, routes_number, cache_path)
+    routes = itertools.islice(routes, worker_index, None, workers_number)
+
+    if load_test:
+        await run_load_test(
+            server, routes, buses_per_route, websockets_number, emulator_id,
+            refresh_timeout, batch_size, stats
+        )
+    else:
+        await run_buses(
+            server, routes, buses_per_route, websockets_number, emulator_id,
+            refresh_timeout, buffer_size, batch_size, batch_timeout, stats
+        )
+
+
+class WorkersStats:
+    """Суммирует счётчики, которые воркеры выкладывают в общую память: по два числа на воркер."""
+
+    def __init__(self, counters):
+        self.counters = counters
+
+    @property
+    def messages(self):
+        return sum(self.counters[0::2])
+
+    @property
+    def updates(self):
+        return sum(self.counters[1::2])
+
+
+async def publish_stats(stats, counters, worker_index):
+    while True:
+        counters[2 * worker_index] = stats.messages
+        counters[2 * worker_index + 1] = stats.updates
+        await trio.sleep(STATS_PUBLISH_DELAY)
+
+
+async def run_worker_emulator(worker_index, counters, emulator_options):
+    stats = LoadStats()
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(publish_stats, stats, counters, worker_index)
+        await run_emulator(**emulator_options, stats=stats, worker_index=worker_index)
+
+
+def run_worker(worker_index, counters, emulator_options, v):
+    """Точка входа процесса-воркера: свои маршруты, свои веб-сокеты и свой префикс к busId."""
+    if v:
+        setup_logger(logger, level=logging.DEBUG)
+
+    emulator_options = {
+        **emulator_options,
+        'emulator_id': generate_worker_id(emulator_options['emulator_id'], worker_index),
+    }
+    try:
+        trio.run(run_worker_emulator, worker_index, counters, emulator_options)
+    except KeyboardInterrupt:
+        pass
+    except OSError as ose:
+        logger.error(f'Connection attempt failed: {ose}')
+
+
+async def run_workers(workers_number, emulator_options, report_interval, v):
+    """Делит маршруты между процессами-воркерами и раз в report_interval сообщает их общую скорость."""
+    context = multiprocessing.get_context('spawn')
+    counters = context.Array('q', 2 * workers_number, lock=False)
+    emulator_options = {**emulator_options, 'workers_number': workers_number}
+    workers = [
+        context.Process(target=run_worker, args=(worker_index, counters, emulator_options, v), daemon=True)
+        for worker_index in range(workers_number)
+    ]
+    for worker in workers:
+        worker.start()
+
+    try:
+        await report_load(WorkersStats(counters), report_interval)
+    finally:
+        for worker in workers:
+            worker.terminate()
 
 
 @click.command()
@@ -78,11 +317,41 @@ async def send_updates(server_address, receive_channel):
     default=0,
     help='Максимальное количество элементов, которое может быть буферизовано в канале перед блокировкой',
 )
+@click.option(
+    '--batch-size',
+    default=1,
+    help='Сколько автобусов отправлять на сервер одним сообщением',
+)
+@click.option(
+    '--batch-timeout',
+    default=0.1,
+    help='Сколько секунд ждать, пока наберётся пачка автобусов',
+)
 @click.option(
     '--directory-path',
     default='routes',
     help='Путь к файлам с маршрутами',
 )
+@click.option(
+    '--load-test',
+    is_flag=True,
+    help='Режим генератора нагрузки: маршруты прямо из каталога в памяти, готовые шаблоны сообщений и отчёт о скорости',
+)
+@click.option(
+    '--cache-path',
+    default=ROUTES_CACHE_PATH,
+    help='Где хранить каталог маршрутов',
+)
+@click.option(
+    '--report-interval',
+    default=REPORT_INTERVAL,
+    help='Как часто генератор нагрузки сообщает о скорости отправки, в секундах',
+)
+@click.option(
+    '--workers',
+    default=0,
+    help='Сколько процессов делят между собой маршруты, 0 — всё в одном процессе',
+)
 @click.option(
     '-v',
     is_flag=True,
@@ -91,32 +360,42 @@ async def send_updates(server_address, receive_channel):
 @suppress(KeyboardInterrupt)
 async def main(
     server, routes_number, buses_per_route, websockets_number,
-    emulator_id, refresh_timeout, buffer_size, directory_path, v
+    emulator_id, refresh_timeout, buffer_size, batch_size, batch_timeout, directory_path,
+    load_test, cache_path, report_interval, workers, v
 ):
 
     if v:
         setup_logger(logger, level=logging.DEBUG)
+    elif load_test or workers:
+        setup_logger(logger, level=logging.INFO)
+
+    emulator_options = dict(
+        server=server,
+        routes_number=routes_number,
+        buses_per_route=buses_per_route,
+        websockets_number=websockets_number,
+        emulator_id=emulator_id,
+        refresh_timeout=refresh_timeout,
+        buffer_size=buffer_size,
+        batch_size=batch_size,
+        batch_timeout=batch_timeout,
+        directory_path=directory_path,
+        load_test=load_test,
+        cache_path=cache_path,
+    )
+
+    if workers:
+        # Каталог собирает родитель, чтобы воркеры не компилировали маршруты наперегонки
+        load_catalogue(directory_path, routes_number, cache_path)
+        await run_workers(workers, emulator_options, report_interval, v)
+        return
 
     try:
+        stats = LoadStats()
         async with trio.open_nursery() as nursery:
-            channels = [trio.open_memory_channel(buffer_size) for _ in range(websockets_number)]
-            for channel in channels:
-                receive_channel = channel[1]
-                nursery.start_soon(send_updates, server, receive_channel)
-
-            for route in load_routes(directory_path, routes_number):
-                for bus_index in range(buses_per_route):
-                    send_channel = random.choice(channels)[0]
-                    bus_id = generate_bus_id(emulator_id, route['name'], bus_index)
-                    start_offset = random.randrange(len(route['coordinates']))
-                    nursery.start_soon(
-                        run_bus,
-                        send_channel,
-                        bus_id,
-                        route['coordinates'],
-                        start_offset,
-                        refresh_timeout
-                    )
+            if load_test:
+                nursery.start_soon(report_load, stats, report_interval)
+            await run_emulator(**emulator_options, stats=stats)
 
     except OSError as ose:
         logger.error(f'Connection attempt failed: {ose}')
@@ -0,0 +1,154 @@
+from array import array
+
+import numpy as np
+
+from bus_store import put_rows, take_rows
+
+# Сколько последних точек помнить для каждого автобуса и сколько памяти отдать под всю историю
+HISTORY_SIZE = 16
+HISTORY_MEMORY = 64 * 1024 * 1024
+EARTH_RADIUS = 6_371_000
+
+
+class PositionHistory:
+    """Кольцевые буферы последних координат автобусов в общих массивах array('d').
+
+    Каждому автобусу выделяется строка из size точек: lat, lng и время. Строк не больше, чем влезает
+    в memory_limit байт, — автобусы сверх этого живут без истории. Строки пропавших автобусов
+    переиспользуются.
+    """
+
+    def __init__(self, size=HISTORY_SIZE, memory_limit=HISTORY_MEMORY):
+        self.size = size
+        self.memory_limit = memory_limit
+        self._slots = {}
+        self._free_slots = []
+        self._heads = array('q')
+        self._counts = array('q')
+        self._lats = array('d')
+        self._lngs = array('d')
+        self._times = array('d')
+
+    def __len__(self):
+        return len(self._slots)
+
+    @property
+    def max_buses(self):
+        return self.memory_limit // (self.size * 3 * self._lats.itemsize)
+
+    def __contains__(self, bus_id):
+        return bus_id in self._slots
+
+    def _allocate(self, bus_id):
+        if self._free_slots:
+            slot = self._free_slots.pop()
+        elif len(self._heads) < self.max_buses:
+            slot = len(self._heads)
+            self._heads.append(0)
+            self._counts.append(0)
+            empty_row = array('d', bytes(self.size * self._lats.itemsize))
+            self._lats.extend(empty_row)
+            self._lngs.extend(empty_row)
+            self._times.extend(empty_row)
+        else:
+            return
+
+        self._heads[slot] = 0
+        self._counts[slot] = 0
+        self._slots[bus_id] = slot
+        return slot
+
+    def record(self, bus_id, lat, lng, timestamp):
+        slot = self._slots.get(bus_id)
+        if slot is None:
+            slot = self._allocate(bus_id)
+            if slot is None:
+                return
+
+        head = self._heads[slot]
+        position = slot * self.size + head
+        self._lats[position] = lat
+        self._lngs[position] = lng
+        self._times[position] = timestamp
+        self._heads[slot] = (head + 1) % self.size
+        if self._counts[slot] < self.size:
+            self._counts[slot] += 1
+
+    def record_many(self, bus_ids, lats, lngs, timestamp):
+        """Записывает сразу много точек с одним временем, busId не должны повторяться."""
+        slots = list(map(self._slots.get, bus_ids))
+        if None in slots:
+            for index, slot in enumerate(slots):
+                if slot is None:
+                    slot = self._allocate(bus_ids[index])
+                    slots[index] = -1 if slot is None else slot
+
+        slots = np.array(slots, dtype=np.int64)
+        # Автобусы, которым не хватило памяти под историю, пропускаем
+        with_history = np.flatnonzero(slots >= 0)
+        slots = slots[with_history]
+
+        heads = take_rows(self._heads, slots)
+        positions = slots * self.size + heads
+        put_rows(self._lats, positions, lats[with_history])
+        put_rows(self._lngs, positions, lngs[with_history])
+        put_rows(self._times, positions, timestamp)
+        put_rows(self._heads, slots, (heads + 1) % self.size)
+        put_rows(self._counts, slots, np.minimum(take_rows(self._counts, slots) + 1, self.size))
+
+    def discard(self, bus_id):
+        slot = self._slots.pop(bus_id, None)
+        if slot is not None:
+            self._free_slots.append(slot)
+
+    def get_trail(self, bus_id, points_number=None):
+        """Возвращает [(lat, lng)] последних точек автобуса от старых к новым."""
+        slot = self._slots.get(bus_id)
+        if slot is None:
+            return []
+
+        count = self._counts[slot]
+        if points_number is not None:
+            count = min(count, points_number)
+        head, base = self._heads[slot], slot * self.size
+        positions = [base + (head - count + index) % self.size for index in range(count)]
+        return [(self._lats[position], self._lngs[position]) for position in positions]
+
+    def find_trails(self, bus_ids, points_number=None):
+        return {bus_id: self.get_trail(bus_id, points_number) for bus_id in bus_ids if bus_id in self._slots}
+
+    def find_motion(self, bus_ids):
+        """Возвращает {busId: (скорость в м/с, курс в градусах от севера)} по двум последним точкам.
+
+        Автобусы, у которых меньше двух точек, пропускаются. Считается numpy сразу для всех автобусов.
+        """
+        bus_ids = [bus_id for bus_id in bus_ids if bus_id in self._slots]
+        if not bus_ids:
+            return {}
+
+        slots = np.array([self._slots[bus_id] for bus_id in bus_ids])
+        heads, counts = take_rows(self._heads, slots), take_rows(self._counts, slots)
+        last = slots * self.size + (heads - 1) % self.size
+        previous = slots * self.size + (heads - 2) % self.size
+        lat1, lng1 = np.radians(take_rows(self._lats, previous)), np.radians(take_rows(self._lngs, previous))
+        lat2, lng2 = np.radians(take_rows(self._lats, last)), np.radians(take_rows(self._lngs, last))
+        time1, time2 = take_rows(self._times, previous), take_rows(self._times, last)
+
+        # Расстояние по формуле гаверсинусов и начальный курс от предыдущей точки к последней
+        lng_delta = lng2 - lng1
+        haversine = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(lng_delta / 2) ** 2
+        distances = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(haversine))
+        headings = np.degrees(np.arctan2(
+            np.sin(lng_delta) * np.cos(lat2),
+            np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(lng_delta),
+        )) % 360
+
+        durations = time2 - time1
+        valid = (counts >= 2) & (durations > 0)
+        speeds = np.divide(distances, durations, out=np.zeros_like(distances), where=valid)
+
+        return {
+            bus_id: (speed, heading)
+            for bus_id, speed, heading, is_valid in zip(bus_ids, speeds.tolist(), headings.tolist(), valid.tolist())
+            if is_valid
+        }
@@ -0,0 +1,148 @@
+import json
+import struct
+
+
+BINARY_SUBPROTOCOL = 'buses.binary'
+COORDINATES_SCALE = 1_000_000
+
+SNAPSHOT_TYPE = 1
+DELTA_TYPE = 2
+
+
+class BusEncoder:
+    """Кэш закодированных автобусов: изменившийся автобус кодируется не больше одного раза за тик."""
+
+    def __init__(self):
+        self._full = {}
+        self._moved = {}
+
+    def invalidate(self, bus_ids):
+        for bus_id in bus_ids:
+            self._full.pop(bus_id, None)
+            self._moved.pop(bus_id, None)
+
+    def get_full(self, bus_id, position):
+        fragment = self._full.get(bus_id)
+        if fragment is None:
+            fragment = self._full[bus_id] = self.encode_full(bus_id, *position)
+        return fragment
+
+    def get_moved(self, bus_id, position):
+        fragment = self._moved.get(bus_id)
+        if fragment is None:
+            fragment = self._moved[bus_id] = self.encode_moved(bus_id, *position[:2])
+        return fragment
+
+
+class JsonEncoder(BusEncoder):
+    def encode_full(self, bus_id, lat, lng, route):
+        return json.dumps({'busId': bus_id, 'lat': lat, 'lng': lng, 'route': route}, ensure_ascii=False)
+
+    def encode_moved(self, bus_id, lat, lng):
+        return json.dumps({'busId': bus_id, 'lat': lat, 'lng': lng}, ensure_ascii=False)
+
+    @staticmethod
+    def join(fragments):
+        return f'[{", ".join(fragments)}]'
+
+    def make_snapshot(self, buses):
+        return f'{{"msgType": "Buses", "buses": {self.join(buses)}}}'
+
+    def make_delta(self, added, moved, removed):
+        return (
+            f'{{"msgType": "BusesUpdate", '
+            f'"added": {self.join(added)}, '
+            f'"moved": {self.join(moved)}, '
+            f'"removed": {json.dumps(removed, ensure_ascii=False)}}}'
+        )
+
+
+class BinaryEncoder(BusEncoder):
+    """Те же сообщения в двоичном виде, little-endian.
+
+    Заголовок: тип сообщения (uint8, 1 — Buses, 2 — BusesUpdate) и число добавленных,
+    сдвинувшихся и удалённых автобусов (3 x uint32). Координаты — int32 в миллионных долях градуса,
+    строки — uint16 с длиной и UTF-8. Добавленный автобус: lat, lng, busId, route.
+    Сдвинувшийся: lat, lng, busId. Удалённый: busId.
+    """
+
+    header = struct.Struct('<BIII')
+    coordinates = struct.Struct('<ii')
+
+    @staticmethod
+    def pack_string(string):
+        encoded = string.encode()
+        return struct.pack('<H', len(encoded)) + encoded
+
+    def pack_coordinates(self, lat, lng):
+        return self.coordinates.pack(round(lat * COORDINATES_SCALE), round(lng * COORDINATES_SCALE))
+
+    def encode_full(self, bus_id, lat, lng, route):
+        return self.pack_coordinates(lat, lng) + self.pack_string(bus_id) + self.pack_string(route)
+
+    def encode_moved(self, bus_id, lat, lng):
+        return self.pack_coordinates(lat, lng) + self.pack_string(bus_id)
+
+    def make_snapshot(self, buses):
+        buses = list(buses)
+        return self.header.pack(SNAPSHOT_TYPE, len(buses), 0, 0) + b''.join(buses)
+
+    def make_delta(self, added, moved, removed):
+        return b''.join((
+            self.header.pack(DELTA_TYPE, len(added), len(moved), len(removed)),
+            *added,
+            *moved,
+            *map(self.pack_string, removed),
+        ))
+
+
+ENCODERS = {
+    'json': JsonEncoder,
+    'binary': BinaryEncoder,
+}
+
+
+def make_snapshot(buses_inside, encoder):
+    return encoder.make_snapshot(encoder.get_full(bus_id, position) for bus_id, position in buses_inside.items())
+
+
+def make_delta(visible, buses_inside, encoder):
+    """Сравнивает то, что браузер уже видит, с автобусами в окне и оставляет только изменения.
+
+    И visible, и buses_inside имеют вид {busId: (lat, lng, route)}.
+    """
+    added, moved = [], []
+    for bus_id, position in buses_inside.items():
+        visible_position = visible.get(bus_id)
+        if visible_position is None or visible_position[2] != position[2]:
+            added.append(encoder.get_full(bus_id, position))
+        elif visible_position != position:
+            moved.append(encoder.get_moved(bus_id, position))
+
+    removed = [bus_id for bus_id in visible if bus_id not in buses_inside]
+
+    if not any((added, moved, removed)):
+        return
+
+    return encoder.make_delta(added, moved, removed)
+
+
+def make_clusters(clusters):
+    clusters = [{'lat': round(lat, 6), 'lng': round(lng, 6), 'count': count} for lat, lng, count in clusters]
+    return json.dumps({'msgType': 'Clusters', 'clusters': clusters})
+
+
+def make_trails(trails):
+    trails = [
+        {'busId': bus_id, 'points': [[round(lat, 6), round(lng, 6)] for lat, lng in points]}
+        for bus_id, points in trails.items()
+    ]
+    return json.dumps({'msgType': 'Trails', 'trails': trails}, ensure_ascii=False)
+
+
+def make_motion(motion):
+    buses = [
+        {'busId': bus_id, 'speed': round(speed, 1), 'heading': round(heading)}
+        for bus_id, (speed, heading) in motion.items()
+    ]
+    return json.dumps({'msgType': 'Motion', 'buses': buses}, ensure_ascii=False)
@@ -0,0 +1,156 @@
+import bisect
+import json
+
+import trio
+
+from utils.decorators import suppress
+
+
+# Корзины гистограмм растут вдвое: от 0.1 мс до ~100 с и от 64 байт до ~32 МБ
+TIME_BUCKETS = tuple(0.0001 * 2 ** power for power in range(21))
+SIZE_BUCKETS = tuple(64 * 2 ** power for power in range(20))
+RATE_INTERVAL = 1
+STATS_READ_TIMEOUT = 1
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.rate = 0.0
+        self._previous_value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def update_rate(self, elapsed):
+        self.rate = (self.value - self._previous_value) / elapsed
+        self._previous_value = self.value
+
+    def as_dict(self):
+        return {'total': self.value, 'per_second': round(self.rate, 1)}
+
+
+class Histogram:
+    """Считает значения по корзинам и отдаёт перцентили за последний завершённый интервал.
+
+    Перцентиль — верхняя граница корзины, в которую он попал, так что точность — в пределах корзины.
+    """
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = buckets
+        self.total_count = 0
+        self._reset()
+        self.summary = self._summarize()
+
+    def _reset(self):
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._count = 0
+        self._sum = 0
+        self._max = 0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._count += 1
+        self._sum += value
+        self._max = max(self._max, value)
+        self.total_count += 1
+
+    def get_quantile(self, quantile):
+        if not self._count:
+            return 0
+        rank = quantile * self._count
+        seen = 0
+        for bucket, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank:
+                return min(self.buckets[bucket], self._max) if bucket < len(self.buckets) else self._max
+
+    def _summarize(self):
+        return {
+            'count': self._count,
+            'mean': self._sum / self._count if self._count else 0,
+            'p50': self.get_quantile(0.5),
+            'p90': self.get_quantile(0.9),
+            'p99': self.get_quantile(0.99),
+            'max': self._max,
+        }
+
+    def rotate(self):
+        self.summary = self._summarize()
+        self._reset()
+
+    def as_dict(self):
+        return {'total_count': self.total_count, **self.summary}
+
+
+class Metrics:
+    """Счётчики, гистограммы и функции-датчики сервера, которые раз в RATE_INTERVAL подводят итоги.
+
+    Таблицы — функции, которые возвращают список словарей, например по строке на каждый браузер.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.tables = {}
+
+    def counter(self, name):
+        return self.counters.setdefault(name, Counter())
+
+    def histogram(self, name, buckets=TIME_BUCKETS):
+        return self.histograms.setdefault(name, Histogram(buckets))
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def table(self, name, function):
+        self.tables[name] = function
+
+    def rotate(self, elapsed):
+        for counter in self.counters.values():
+            counter.update_rate(elapsed)
+        for histogram in self.histograms.values():
+            histogram.rotate()
+
+    def as_dict(self):
+        return {
+            'counters': {name: counter.as_dict() for name, counter in self.counters.items()},
+            'gauges': {name: function() for name, function in self.gauges.items()},
+            'histograms': {name: histogram.as_dict() for name, histogram in self.histograms.items()},
+            'tables': {name: function() for name, function in self.tables.items()},
+        }
+
+    async def run(self, interval=RATE_INTERVAL):
+        previous_time = trio.current_time()
+        while True:
+            await trio.sleep(interval)
+            now = trio.current_time()
+            self.rotate(now - previous_time)
+            previous_time = now
+
+
+async def receive_request(stream):
+    request = b''
+    with trio.move_on_after(STATS_READ_TIMEOUT):
+        while b'\r\n\r\n' not in request:
+            chunk = await stream.receive_some()
+            if not chunk:
+                break
+            request += chunk
+    return request
+
+
+@suppress(trio.BrokenResourceError)
+async def serve_stats(stream, metrics):
+    """Отвечает на любой HTTP-запрос текущими метриками в JSON и закрывает соединение."""
+    async with stream:
+        await receive_request(stream)
+        body = json.dumps(metrics.as_dict(), indent=2).encode()
+        headers = (
+            'HTTP/1.1 200 OK\r\n'
+            'Content-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            'Connection: close\r\n\r\n'
+        )
+        await stream.send_all(headers.encode() + body)
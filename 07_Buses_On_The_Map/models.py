@@ -7,19 +7,23 @@ class WindowBounds:
     north_lat: float = None
     east_lng: float = None
     west_lng: float = None
+    zoom: float = None
 
     def is_null(self):
         return not any((self.south_lat, self.north_lat, self.east_lng, self.west_lng))
 
-    def update(self, south_lat, north_lat, east_lng, west_lng):
+    def update(self, south_lat, north_lat, east_lng, west_lng, zoom=None):
         self.south_lat = south_lat
         self.north_lat = north_lat
         self.east_lng = east_lng
         self.west_lng = west_lng
+        self.zoom = zoom
 
 
 @dataclasses.dataclass
 class Bus:
+    __slots__ = ('busId', 'lat', 'lng', 'route')
+
     busId: str
     lat: float
     lng: float
@@ -0,0 +1,94 @@
+import itertools
+import logging
+from contextlib import AsyncExitStack
+from functools import partial
+
+import asyncclick as click
+import trio
+from trio_websocket import ConnectionClosed, open_websocket_url, serve_websocket
+
+from utils.decorators import suppress
+from utils.setup import setup_logger
+from utils.traffic import write_frame
+
+
+logger = logging.getLogger('record_traffic')
+
+
+class TrafficRecorder:
+    """Дописывает в конец файла сообщения имитатора вместе со временем прихода и номером соединения."""
+
+    def __init__(self, file):
+        self.file = file
+        self.started_at = None
+        self.frames_number = 0
+        self._connections = itertools.count()
+
+    def open_connection(self):
+        return next(self._connections)
+
+    def write(self, connection, message):
+        now = trio.current_time()
+        if self.started_at is None:
+            self.started_at = now
+        write_frame(self.file, now - self.started_at, connection, message)
+        self.frames_number += 1
+
+
+@suppress(ConnectionClosed)
+async def record_bus(request, recorder, server):
+    ws = await request.accept()
+    connection = recorder.open_connection()
+
+    async with AsyncExitStack() as stack:
+        upstream = None
+        if server:
+            upstream = await stack.enter_async_context(open_websocket_url(server, ssl_context=None))
+
+        while True:
+            message = await ws.get_message()
+            recorder.write(connection, message)
+            if upstream:
+                await upstream.send_message(message)
+
+
+@click.command()
+@click.option(
+    '--host',
+    default='127.0.0.1',
+    help='Адрес хоста',
+)
+@click.option(
+    '--port',
+    default=8081,
+    help='Порт, к которому подключается имитатор автобусов',
+)
+@click.option(
+    '--server',
+    default='',
+    help='Адрес сервера, которому пересылать записанные сообщения, по умолчанию никому',
+)
+@click.option(
+    '--output',
+    default='traffic.rec',
+    help='Файл для записи, новые сообщения дописываются в конец',
+)
+@click.option(
+    '-v',
+    is_flag=True,
+    help='Настройка логирования',
+)
+@suppress(KeyboardInterrupt)
+async def main(host, port, server, output, v):
+    setup_logger(logger, level=logging.DEBUG if v else logging.INFO)
+
+    with open(output, 'ab') as file:
+        recorder = TrafficRecorder(file)
+        try:
+            await serve_websocket(partial(record_bus, recorder=recorder, server=server), host, port, ssl_context=None)
+        finally:
+            logger.info(f'Recorded {recorder.frames_number} frames to {output}')
+
+
+if __name__ == '__main__':
+    main(_anyio_backend='trio')
@@ -1,4 +1,63 @@
-from pydantic import BaseModel
+import json
+import math
+from typing import List, Optional
+
+from pydantic import BaseModel, ValidationError, conint, constr, validator
+from pydantic.error_wrappers import ErrorWrapper
+from pydantic.utils import ROOT_KEY
+
+from models import Bus
+
+
+MAX_LAT = 90
+MAX_LNG = 180
+# Двоичный формат браузеров хранит длину строки в uint16, а символ UTF-8 занимает до 4 байт
+MAX_NAME_LENGTH = 256
+# У Leaflet зум не бывает больше 30, а 2 ** zoom для огромных значений не помещается во float
+MAX_ZOOM = 30
+
+
+def is_finite(value):
+    # json.loads отдаёт длинные целые как int, а на int больше float math.isfinite бросает OverflowError
+    try:
+        return math.isfinite(value)
+    except OverflowError:
+        return False
+
+
+def is_coordinate_valid(value, limit):
+    return is_finite(value) and -limit <= value <= limit
+
+
+def is_timestamp_valid(value):
+    return is_finite(value) and value >= 0
+
+
+def to_float(value):
+    """Заменяет целое, которое не помещается во float, бесконечностью того же знака.
+
+    Иначе pydantic при приведении к float бросит OverflowError вместо ошибки проверки,
+    а так бесконечность отклонят обычные проверки поля.
+    """
+    if type(value) is int:
+        try:
+            return float(value)
+        except OverflowError:
+            return math.inf if value > 0 else -math.inf
+    return value
+
+
+def check_timestamp(value):
+    if value is not None and not is_timestamp_valid(value):
+        raise ValueError('ensure this value is a finite unix time')
+    return value
+
+
+def check_coordinate(value, limit):
+    # json.loads пропускает NaN и Infinity, а сетки индексов на них падают
+    if not is_coordinate_valid(value, limit):
+        raise ValueError(f'ensure this value is a finite number between {-limit} and {limit}')
+    return value
 
 
 class WindowBoundsDataSerializer(BaseModel):
@@ -6,6 +65,23 @@ class WindowBoundsDataSerializer(BaseModel):
     north_lat: float
     south_lat: float
     west_lng: float
+    zoom: Optional[float] = None
+
+    _to_float = validator('south_lat', 'north_lat', 'east_lng', 'west_lng', 'zoom', pre=True, allow_reuse=True)(to_float)
+
+    @validator('south_lat', 'north_lat')
+    def check_lat(cls, value):
+        return check_coordinate(value, MAX_LAT)
+
+    @validator('east_lng', 'west_lng')
+    def check_lng(cls, value):
+        return check_coordinate(value, MAX_LNG)
+
+    @validator('zoom')
+    def check_zoom(cls, value):
+        if value is not None and not (is_finite(value) and 0 <= value <= MAX_ZOOM):
+            raise ValueError(f'ensure this value is a finite number between 0 and {MAX_ZOOM}')
+        return value
 
 
 class WindowBoundsSerializer(BaseModel):
@@ -13,8 +89,132 @@ class WindowBoundsSerializer(BaseModel):
     data: WindowBoundsDataSerializer
 
 
+class HistoryRequestDataSerializer(BaseModel):
+    points: Optional[conint(ge=1)] = None
+
+
+class HistoryRequestSerializer(BaseModel):
+    msgType: str
+    data: HistoryRequestDataSerializer = HistoryRequestDataSerializer()
+
+
+HISTORY_REQUESTS = ('getTrails', 'getMotion')
+
+
+def parse_browser_message(message):
+    """Разбирает запрос истории автобусов или, как раньше, новые границы окна."""
+    try:
+        msg_type = json.loads(message).get('msgType')
+    except (ValueError, AttributeError):
+        msg_type = None
+
+    if msg_type in HISTORY_REQUESTS:
+        return HistoryRequestSerializer.parse_raw(message)
+    return WindowBoundsSerializer.parse_raw(message)
+
+
 class BusSerializer(BaseModel):
-    busId: str
+    busId: constr(max_length=MAX_NAME_LENGTH)
     lat: float
     lng: float
-    route: str
+    route: constr(max_length=MAX_NAME_LENGTH)
+
+    _to_float = validator('lat', 'lng', pre=True, allow_reuse=True)(to_float)
+
+    @validator('lat')
+    def check_lat(cls, value):
+        return check_coordinate(value, MAX_LAT)
+
+    @validator('lng')
+    def check_lng(cls, value):
+        return check_coordinate(value, MAX_LNG)
+
+
+class StampedBusSerializer(BusSerializer):
+    """Сообщение с одним автобусом. timestamp — когда имитатор отправил сообщение, в секундах unix time."""
+
+    timestamp: Optional[float] = None
+
+    _to_float = validator('timestamp', pre=True, allow_reuse=True)(to_float)
+    _check_timestamp = validator('timestamp', allow_reuse=True)(check_timestamp)
+
+
+class BusesSerializer(BaseModel):
+    msgType: str
+    buses: List[BusSerializer]
+    timestamp: Optional[float] = None
+
+    _to_float = validator('timestamp', pre=True, allow_reuse=True)(to_float)
+    _check_timestamp = validator('timestamp', allow_reuse=True)(check_timestamp)
+
+
+def parse_buses(message):
+    """Разбирает сообщение с одним автобусом или с пачкой автобусов в поле buses.
+
+    Возвращает автобусы и timestamp сообщения, если имитатор его проставил, иначе None.
+    """
+    try:
+        buses = json.loads(message)
+    except ValueError as error:
+        raise ValidationError([ErrorWrapper(error, loc=ROOT_KEY)], BusSerializer)
+
+    if isinstance(buses, dict) and 'buses' in buses:
+        frame = BusesSerializer.parse_obj(buses)
+        buses = frame.buses
+    else:
+        frame = StampedBusSerializer.parse_obj(buses)
+        buses = [frame]
+
+    return [Bus(bus.busId, bus.lat, bus.lng, bus.route) for bus in buses], frame.timestamp
+
+
+def _get_bus(bus):
+    try:
+        bus_id, lat, lng, route = bus['busId'], bus['lat'], bus['lng'], bus['route']
+    except (KeyError, TypeError):
+        return
+
+    if type(bus_id) is not str or type(route) is not str:
+        return
+    if len(bus_id) > MAX_NAME_LENGTH or len(route) > MAX_NAME_LENGTH:
+        return
+    if type(lat) not in (float, int) or type(lng) not in (float, int):
+        return
+    if is_coordinate_valid(lat, MAX_LAT) and is_coordinate_valid(lng, MAX_LNG):
+        return Bus(bus_id, float(lat), float(lng), route)
+
+
+def _get_timestamp(frame):
+    """Возвращает timestamp сообщения, None, если его нет, и False, если он не число."""
+    timestamp = frame.get('timestamp')
+    if timestamp is None:
+        return
+    if type(timestamp) not in (float, int) or not is_timestamp_valid(timestamp):
+        return False
+    return float(timestamp)
+
+
+def parse_buses_fast(message):
+    """То же, что parse_buses, но без моделей pydantic.
+
+    Пропускает только поля ровно тех типов, что ждёт BusSerializer. Всё остальное,
+    в том числе ошибки, разбирает parse_buses, так что ответ об ошибке не меняется.
+    """
+    try:
+        buses = json.loads(message)
+    except ValueError:
+        buses = None
+
+    timestamp = _get_timestamp(buses) if isinstance(buses, dict) else False
+    if timestamp is not False:
+        if 'buses' not in buses:
+            bus = _get_bus(buses)
+            if bus:
+                return [bus], timestamp
+
+        elif type(buses.get('msgType')) is str and type(buses['buses']) is list:
+            parsed_buses = [_get_bus(bus) for bus in buses['buses']]
+            if all(parsed_buses):
+                return parsed_buses, timestamp
+
+    return parse_buses(message)
@@ -1,84 +1,259 @@
-import dataclasses
-import json
+import heapq
 import logging
+import time
+from array import array
 from contextlib import asynccontextmanager
 from functools import partial
 
 import asyncclick as click
+import numpy as np
 import trio
 from pydantic import ValidationError
 from trio_websocket import serve_websocket, ConnectionClosed
 
-from models import Bus, WindowBounds
-from serializers import WindowBoundsSerializer, BusSerializer
+from broadcaster import Broadcaster
+from bus_store import BusStore
+from clusters import ClusterIndex
+from expiry import LastSeen
+from history import PositionHistory
+from messages import BINARY_SUBPROTOCOL, make_motion, make_trails
+from metrics import SIZE_BUCKETS, Metrics, serve_stats
+from serializers import HistoryRequestSerializer, parse_browser_message, parse_buses, parse_buses_fast
+from sessions import SessionRegistry
+from snapshots import read_snapshot, write_snapshot
+from shards import collect_updates, flush_updates, serve_reuse_port_websocket, serve_shards
 from utils.decorators import suppress
 from utils.setup import setup_logger
 
 
-DELAY = 0.5
-buses = {}
+EXPIRE_DELAY = 0.5
+SNAPSHOT_INTERVAL = 5
+# Сколько браузеров показывать в метриках: с тысячами браузеров сводка выросла бы до мегабайт
+STATS_SESSIONS_LIMIT = 100
+metrics = Metrics()
+ingest_messages = metrics.counter('ingest_messages')
+ingest_buses = metrics.counter('ingest_buses')
+ingest_errors = metrics.counter('ingest_validation_errors')
+browser_errors = metrics.counter('browser_validation_errors')
+browser_messages = metrics.counter('browser_messages')
+browser_bytes = metrics.counter('browser_bytes')
+message_size = metrics.histogram('browser_message_bytes', SIZE_BUCKETS)
+latency = metrics.histogram('ingest_to_browser_seconds')
+
+buses = BusStore()
+clusters = ClusterIndex()
+sessions = SessionRegistry(buses.index)
+broadcaster = Broadcaster(buses, sessions, clusters, fanout_time=metrics.histogram('fanout_seconds'))
+last_seen = LastSeen()
+history = PositionHistory()
 logger = logging.getLogger('server')
 
+metrics.gauge('buses', lambda: len(buses))
+metrics.gauge('grid_cells', lambda: buses.index.cells_number)
+metrics.gauge('browsers', lambda: len(sessions))
+metrics.gauge('buses_with_history', lambda: len(history))
+metrics.gauge('bytes_per_browser_per_second', lambda: browser_bytes.rate / len(sessions) if len(sessions) else 0)
+metrics.gauge('mailbox_messages', lambda: sum(len(session.mailbox) for session in sessions))
+metrics.gauge('mailbox_dropped', lambda: sum(session.mailbox.dropped for session in sessions))
+metrics.table('browser_sessions', lambda: [
+    session.as_dict()
+    for session in heapq.nlargest(STATS_SESSIONS_LIMIT, sessions, key=lambda session: session.sent_bytes)
+])
+
 
 @asynccontextmanager
-async def handle_errors(ws):
+async def handle_errors(ws, errors_counter):
     try:
         yield
 
     except ValidationError as error:
+        errors_counter.inc()
         await ws.send_message(error.json())
 
 
+def store_buses(parsed_buses, timestamp=None):
+    """timestamp — когда имитатор отправил сообщение. Без него задержка считается от прихода сообщения."""
+    now = trio.current_time()
+    ingest_buses.inc(len(parsed_buses))
+    if timestamp is None:
+        timestamp = time.time()
+    for bus in parsed_buses:
+        old_position, *cells = buses.update(bus)
+        clusters.move(old_position, bus.lat, bus.lng)
+        last_seen.touch(bus.busId, now)
+        history.record(bus.busId, bus.lat, bus.lng, now)
+        broadcaster.notify(bus.busId, *cells, changed_at=timestamp)
+
+
+def store_batch(bus_ids, routes, lats, lngs, timestamps, messages_number=0, errors_number=0):
+    """То же, что store_buses, для пачки от воркера: busId не повторяются, остальное — массивы numpy.
+
+    messages_number и errors_number — сколько сообщений воркер принял и отклонил с прошлой пачки.
+    """
+    ingest_messages.inc(messages_number)
+    ingest_errors.inc(errors_number)
+    if not bus_ids:
+        return
+
+    now = trio.current_time()
+    ingest_buses.inc(len(bus_ids))
+    old_lats, old_lngs, cells = buses.update_many(bus_ids, routes, lats, lngs)
+    clusters.move_many(old_lats, old_lngs, lats, lngs)
+    last_seen.touch_many(bus_ids, now)
+    history.record_many(bus_ids, lats, lngs, now)
+    broadcaster.notify_many(bus_ids, cells, changed_at=float(timestamps.min()))
+
+
 @suppress(ConnectionClosed)
-async def fetch_coordinates(request):
+async def fetch_coordinates(request, parse_buses=parse_buses_fast, store_buses=store_buses):
     ws = await request.accept()
-    global buses
 
     while True:
-        async with handle_errors(ws):
+        async with handle_errors(ws, ingest_errors):
             message = await ws.get_message()
-            bus = BusSerializer.parse_raw(message).dict()
-            buses[bus['busId']] = Bus(**bus)
+            ingest_messages.inc()
+            store_buses(*parse_buses(message))
+
+
+async def serve_ingest_worker(host, bus_port, parse_buses, coordinator_port):
+    updates = {}
+    stream = await trio.open_tcp_stream('127.0.0.1', coordinator_port)
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(flush_updates, stream, updates, ingest_messages, ingest_errors)
+        handler = partial(fetch_coordinates, parse_buses=parse_buses, store_buses=partial(collect_updates, updates))
+        await serve_reuse_port_websocket(handler, host, bus_port)
+
+
+def run_ingest_worker(*args):
+    try:
+        trio.run(serve_ingest_worker, *args)
+    except KeyboardInterrupt:
+        pass
+
+
+async def expire_buses():
+    while True:
+        for bus_id in last_seen.pop_expired(trio.current_time()):
+            position, cell = buses.remove(bus_id)
+            clusters.discard(*position)
+            history.discard(bus_id)
+            broadcaster.notify(bus_id, cell)
+            logger.debug(f'Bus {bus_id} expired')
+        await trio.sleep(EXPIRE_DELAY)
+
+
+def take_snapshot():
+    now = trio.current_time()
+    bus_ids, routes, lats, lngs = buses.get_columns()
+    ages = array('d', (now - last_seen.get(bus_id, now) for bus_id in bus_ids))
+    return time.time(), bus_ids, routes, lats, lngs, ages
 
 
-async def send_buses(ws, bounds):
-    buses_inside = [dataclasses.asdict(bus) for bus in buses.values() if bus.is_inside(bounds)]
-    logger.debug(f'{len(buses_inside)} buses inside bounds')
+async def save_snapshots(path, interval):
+    """Раз в interval сохраняет автобусы на диск. Колонки копируются в цикле событий, а пишутся в потоке."""
+    try:
+        while True:
+            await trio.sleep(interval)
+            await trio.to_thread.run_sync(write_snapshot, path, take_snapshot())
+    finally:
+        # При остановке сервера сохраняем самое свежее состояние для следующего запуска
+        write_snapshot(path, take_snapshot())
+
 
-    if not buses_inside:
+def restore_buses(path):
+    """Загружает автобусы из снимка, если он есть, с учётом того, сколько сервер был выключен.
+
+    Автобусы, которые за это время успели бы пропасть с карты, не восстанавливаются.
+    """
+    try:
+        saved_at, (bus_ids, routes, lats, lngs, ages) = read_snapshot(path)
+    except FileNotFoundError:
         return
+    except ValueError as error:
+        logger.error(f'Snapshot {path} is broken: {error}')
+        return
+
+    ages = np.frombuffer(ages) + max(time.time() - saved_at, 0)
+    # LastSeen хранит автобусы от самого давнего, так что восстанавливаем их от самых старых координат
+    slots = np.argsort(-ages, kind='stable')
+    slots = slots[ages[slots] < last_seen.ttl]
 
-    message = {
-        "msgType": "Buses",
-        "buses": buses_inside
-    }
+    lats, lngs = np.frombuffer(lats)[slots], np.frombuffer(lngs)[slots]
+    bus_ids = [bus_ids[slot] for slot in slots.tolist()]
+    routes = [routes[slot] for slot in slots.tolist()]
 
-    await ws.send_message(json.dumps(message, ensure_ascii=False))
+    buses.load_columns(bus_ids, routes, lats.tobytes(), lngs.tobytes())
+    clusters.add_many(lats, lngs)
+    now = trio.current_time()
+    for bus_id, age in zip(bus_ids, ages[slots].tolist()):
+        last_seen.touch(bus_id, now - age)
+    logger.debug(f'Restored {len(buses)} buses from {path}')
 
 
 @suppress(ConnectionClosed)
-async def talk_to_browser(ws, bounds):
+async def talk_to_browser(session):
     while True:
-        await send_buses(ws, bounds)
-        await trio.sleep(DELAY)
+        message, visible, changed_at = await session.mailbox.get()
+        if visible is not None:
+            session.visible = visible
+        await session.ws.send_message(message)
+
+        size = len(message) if isinstance(message, bytes) else len(message.encode())
+        session.sent_bytes += size
+        browser_messages.inc()
+        browser_bytes.inc(size)
+        message_size.observe(size)
+        if changed_at is not None:
+            # Часы имитатора могут спешить, отрицательная задержка ничего не говорит
+            latency.observe(max(time.time() - changed_at, 0))
 
 
 @suppress(ConnectionClosed)
-async def listen_browser(ws, bounds):
+async def listen_browser(session):
     while True:
-        async with handle_errors(ws):
-            message = await ws.get_message()
-            bounds_data = WindowBoundsSerializer.parse_raw(message).dict()
-
-            bounds.update(**bounds_data['data'])
+        async with handle_errors(session.ws, browser_errors):
+            message = await session.ws.get_message()
+            request = parse_browser_message(message)
             logger.debug(message)
 
+            if isinstance(request, HistoryRequestSerializer):
+                answer_history_request(session, request)
+            else:
+                sessions.update_bounds(session, **request.dict()['data'])
 
-async def handle_browser(request, bounds):
-    ws = await request.accept()
-    async with trio.open_nursery() as nursery:
-        nursery.start_soon(talk_to_browser, ws, bounds)
-        nursery.start_soon(listen_browser, ws, bounds)
+
+def answer_history_request(session, request):
+    """Отвечает следами или скоростью и курсом автобусов, которые браузер сейчас видит.
+
+    Ответ уходит через ящик сессии, как и остальные сообщения: медленный браузер не задерживает
+    чтение своих запросов, а ответ попадает в метрики отправленных сообщений и байт.
+    """
+    if request.msgType == 'getTrails':
+        message = make_trails(history.find_trails(session.visible, request.data.points))
+    else:
+        message = make_motion(history.find_motion(session.visible))
+    session.mailbox.put_reply(request.msgType, message)
+
+
+async def handle_browser(request):
+    if BINARY_SUBPROTOCOL in request.proposed_subprotocols:
+        ws = await request.accept(subprotocol=BINARY_SUBPROTOCOL)
+        session = sessions.add(ws, encoding='binary')
+    else:
+        ws = await request.accept()
+        session = sessions.add(ws)
+
+    try:
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(talk_to_browser, session)
+            await listen_browser(session)
+            nursery.cancel_scope.cancel()
+    finally:
+        sessions.remove(session)
+        logger.debug(
+            f'Session {session.session_id} closed: '
+            f'{session.mailbox.sent} messages sent, {session.mailbox.dropped} dropped'
+        )
 
 
 @click.command()
@@ -97,23 +272,104 @@ async def handle_browser(request, bounds):
     default=8000,
     help='Порт для браузера',
 )
+@click.option(
+    '--bus-ttl',
+    default=last_seen.ttl,
+    help='Через сколько секунд без новых координат автобус пропадает с карты',
+)
+@click.option(
+    '--fast-ingest/--no-fast-ingest',
+    default=True,
+    help='Проверять координаты автобусов без pydantic, если сообщение корректно',
+)
+@click.option(
+    '--cluster-threshold',
+    default=broadcaster.cluster_threshold,
+    help='Сколько автобусов должно попасть в окно, чтобы вместо них браузер получил кластеры',
+)
+@click.option(
+    '--coalesce-window',
+    default=broadcaster.coalesce_window,
+    help='Сколько секунд после первого изменения копить следующие, чтобы отправить браузеру одним сообщением',
+)
+@click.option(
+    '--max-rate',
+    default=broadcaster.max_rate,
+    type=float,
+    help='Сколько сообщений в секунду можно отправить одному браузеру, 0 — без ограничения',
+)
+@click.option(
+    '--workers',
+    default=0,
+    help='Сколько процессов разбирают сообщения имитатора для основного процесса, 0 — всё в одном процессе',
+)
+@click.option(
+    '--history-size',
+    default=history.size,
+    help='Сколько последних точек каждого автобуса помнить для следов и расчёта скорости',
+)
+@click.option(
+    '--history-memory',
+    default=history.memory_limit // 1024 // 1024,
+    help='Сколько мегабайт отдать под историю всех автобусов',
+)
+@click.option(
+    '--snapshot-path',
+    default='',
+    help='Куда сохранять автобусы, чтобы после перезапуска сразу показать их браузерам, по умолчанию не сохранять',
+)
+@click.option(
+    '--snapshot-interval',
+    default=SNAPSHOT_INTERVAL,
+    help='Как часто сохранять автобусы, в секундах',
+)
+@click.option(
+    '--stats-port',
+    default=8001,
+    help='Порт, на котором по HTTP отдаются метрики сервера в JSON, 0 — не отдавать',
+)
 @click.option(
     '-v',
     is_flag=True,
     help='Настройка логирования',
 )
 @suppress(KeyboardInterrupt)
-async def main(host, bus_port, browser_port, v):
+async def main(
+    host, bus_port, browser_port, bus_ttl, fast_ingest, cluster_threshold,
+    coalesce_window, max_rate, workers, history_size, history_memory, snapshot_path, snapshot_interval,
+    stats_port, v
+):
     if v:
         setup_logger(logger, level=logging.DEBUG)
 
-    bounds = WindowBounds()
+    last_seen.ttl = bus_ttl
+    broadcaster.cluster_threshold = cluster_threshold
+    broadcaster.coalesce_window = coalesce_window
+    broadcaster.max_rate = max_rate
+    history.size = history_size
+    history.memory_limit = history_memory * 1024 * 1024
+    ingest_parser = parse_buses_fast if fast_ingest else parse_buses
+    if snapshot_path:
+        restore_buses(snapshot_path)
+
     async with trio.open_nursery() as nursery:
+        nursery.start_soon(broadcaster.run)
+        nursery.start_soon(expire_buses)
+        nursery.start_soon(metrics.run)
+        if snapshot_path:
+            nursery.start_soon(save_snapshots, snapshot_path, snapshot_interval)
+        if stats_port:
+            nursery.start_soon(partial(trio.serve_tcp, partial(serve_stats, metrics=metrics), stats_port, host=host))
+        if workers:
+            nursery.start_soon(
+                serve_shards, workers, run_ingest_worker, (host, bus_port, ingest_parser), store_batch
+            )
+        else:
+            nursery.start_soon(
+                partial(serve_websocket, partial(fetch_coordinates, parse_buses=ingest_parser), host, bus_port, ssl_context=None)
+            )
         nursery.start_soon(
-            partial(serve_websocket, fetch_coordinates, host, bus_port, ssl_context=None)
-        )
-        nursery.start_soon(
-            partial(serve_websocket, partial(handle_browser, bounds=bounds), host, browser_port, ssl_context=None)
+            partial(serve_websocket, handle_browser, host, browser_port, ssl_context=None)
         )
 
 
@@ -0,0 +1,196 @@
+import dataclasses
+import time
+from collections import defaultdict
+from itertools import count
+
+import trio
+
+from models import WindowBounds
+
+
+# Окно шире этого числа ячеек подписываем на все изменения, а не на каждую ячейку отдельно
+MAX_SUBSCRIBED_CELLS = 10_000
+
+_session_ids = count(1)
+
+
+class Mailbox:
+    """Ящик на одно сообщение: пока браузер не забрал прошлое сообщение, новое его вытесняет.
+
+    Ответы на запросы истории лежат отдельно, по одному на каждый вид запроса: они не меняют того,
+    что видит браузер, поэтому не должны вытеснять изменения автобусов, а те — их. Новый ответ
+    вытесняет только прежний ответ на такой же запрос.
+    """
+
+    def __init__(self):
+        self._pending = None
+        self._replies = {}
+        self._has_message = trio.Event()
+        self.sent = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return int(self._pending is not None) + len(self._replies)
+
+    def _update_event(self):
+        if len(self):
+            self._has_message.set()
+        elif self._has_message.is_set():
+            self._has_message = trio.Event()
+
+    @property
+    def has_snapshot(self):
+        return self._pending is not None and self._pending[2]
+
+    def put(self, message, visible, is_snapshot, changed_at=None):
+        """changed_at — когда отправлены самые старые координаты из сообщения, чтобы замерить задержку."""
+        if self._pending is not None:
+            self.dropped += 1
+            # Новое сообщение посчитано от того же состояния браузера, так что несёт и вытесненные изменения
+            pending_changed_at = self._pending[3]
+            if changed_at is None or pending_changed_at is not None and pending_changed_at < changed_at:
+                changed_at = pending_changed_at
+
+        self._pending = None if message is None else (message, visible, is_snapshot, changed_at)
+        self._update_event()
+
+    def put_reply(self, kind, message):
+        """Кладёт ответ на запрос браузера вида kind, который не меняет того, что браузер видит."""
+        if kind in self._replies:
+            self.dropped += 1
+        self._replies[kind] = message
+        self._update_event()
+
+    async def get(self):
+        """Возвращает сообщение, то, что браузер увидит после него, и время самых старых координат в нём.
+
+        У ответа на запрос вместо того, что увидит браузер, возвращается None: видимое не меняется.
+        """
+        while not len(self):
+            await self._has_message.wait()
+
+        if self._replies:
+            message, visible, changed_at = self._replies.pop(next(iter(self._replies))), None, None
+        else:
+            message, visible, _, changed_at = self._pending
+            self._pending = None
+        self._update_event()
+        self.sent += 1
+        return message, visible, changed_at
+
+
+@dataclasses.dataclass(eq=False)
+class BrowserSession:
+    ws: object
+    encoding: str = 'json'
+    session_id: int = dataclasses.field(default_factory=lambda: next(_session_ids))
+    bounds: WindowBounds = dataclasses.field(default_factory=WindowBounds)
+    cells: frozenset = frozenset()
+    is_wide: bool = False
+    needs_snapshot: bool = False
+    changed_at: float = None
+    next_send_at: float = 0
+    visible: dict = dataclasses.field(default_factory=dict)
+    mailbox: Mailbox = dataclasses.field(default_factory=Mailbox)
+    sent_bytes: int = 0
+
+    def as_dict(self):
+        return {
+            'session_id': self.session_id,
+            'encoding': self.encoding,
+            'messages': self.mailbox.sent,
+            'bytes': self.sent_bytes,
+            'dropped': self.mailbox.dropped,
+            'mailbox_depth': len(self.mailbox),
+        }
+
+
+class SessionRegistry:
+    """Хранит подключенные браузеры и индекс «ячейка сетки -> браузеры, которые её видят»."""
+
+    def __init__(self, index):
+        self.index = index
+        self.dirty = set()
+        self._sessions = set()
+        self._cell_sessions = defaultdict(set)
+        self._wide_sessions = set()
+        self._has_dirty = trio.Event()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __iter__(self):
+        return iter(self._sessions)
+
+    def add(self, ws, encoding='json'):
+        session = BrowserSession(ws, encoding)
+        self._sessions.add(session)
+        return session
+
+    def remove(self, session):
+        self._unsubscribe(session)
+        self._sessions.discard(session)
+        self.dirty.discard(session)
+
+    def _mark_dirty(self, session, changed_at=None):
+        if session not in self.dirty:
+            session.changed_at = changed_at
+            self.dirty.add(session)
+            self._has_dirty.set()
+        # Имитаторы шлют по разным соединениям, так что координаты, пришедшие позже, могут быть старше
+        elif changed_at is not None and (session.changed_at is None or changed_at < session.changed_at):
+            session.changed_at = changed_at
+
+    async def wait_dirty(self):
+        """Ждёт, пока хоть одному браузеру будет что отправить. Пока всё стоит, рассылка спит."""
+        while not self.dirty:
+            self._has_dirty = trio.Event()
+            await self._has_dirty.wait()
+
+    def update_bounds(self, session, south_lat, north_lat, east_lng, west_lng, zoom=None):
+        session.bounds.update(south_lat, north_lat, east_lng, west_lng, zoom)
+        self._unsubscribe(session)
+
+        south, west, north, east = self.index.get_cell_range(session.bounds)
+        cells_number = max(north - south + 1, 0) * max(east - west + 1, 0)
+
+        if cells_number > MAX_SUBSCRIBED_CELLS:
+            session.is_wide = True
+            self._wide_sessions.add(session)
+        else:
+            session.cells = frozenset(
+                (lat_index, lng_index)
+                for lat_index in range(south, north + 1)
+                for lng_index in range(west, east + 1)
+            )
+            for cell in session.cells:
+                self._cell_sessions[cell].add(session)
+
+        session.needs_snapshot = True
+        self._mark_dirty(session)
+
+    def _unsubscribe(self, session):
+        for cell in session.cells:
+            cell_sessions = self._cell_sessions[cell]
+            cell_sessions.discard(session)
+            if not cell_sessions:
+                del self._cell_sessions[cell]
+
+        session.cells = frozenset()
+        session.is_wide = False
+        self._wide_sessions.discard(session)
+
+    def find_interested(self, *cells):
+        """Возвращает браузеры, которым видна хотя бы одна из ячеек."""
+        interested = set(self._wide_sessions)
+        for cell in cells:
+            if cell is not None:
+                interested.update(self._cell_sessions.get(cell, ()))
+        return interested
+
+    def notify(self, *cells, changed_at=None):
+        """changed_at — когда имитатор отправил координаты, в секундах unix time, по умолчанию — сейчас."""
+        if changed_at is None:
+            changed_at = time.time()
+        for session in self.find_interested(*cells):
+            self._mark_dirty(session, changed_at)
@@ -0,0 +1,159 @@
+import logging
+import multiprocessing
+import socket
+import struct
+import time
+from array import array
+from functools import partial
+
+import numpy as np
+import trio
+from trio_websocket import WebSocketServer
+
+
+FLUSH_DELAY = 0.01
+HEADER = struct.Struct('!I')
+# Число автобусов в пачке, размеры в байтах busId и маршрутов, записанных подряд в UTF-8,
+# и сколько сообщений имитатора воркер принял и сколько из них не прошло проверку с прошлой пачки
+BATCH_HEADER = struct.Struct('=IIIII')
+logger = logging.getLogger('server')
+
+
+def open_reuse_port_listener(host, port):
+    """Несколько процессов слушают один порт, а ядро само раскидывает между ними подключения."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen()
+    return trio.SocketListener(trio.socket.from_stdlib_socket(sock))
+
+
+async def serve_reuse_port_websocket(handler, host, port):
+    server = WebSocketServer(handler, [open_reuse_port_listener(host, port)])
+    await server.run()
+
+
+def pack_batch(buses, timestamps, messages_number=0, errors_number=0):
+    """Укладывает автобусы в пачку колонками, чтобы координатор не разбирал JSON и не создавал объекты Bus.
+
+    После заголовка идут lat, lng и время отправки координат имитатором как float64, длины busId
+    и маршрутов в символах как uint16, а затем сами busId и маршруты подряд в UTF-8. Воркеры
+    и координатор живут на одной машине, поэтому порядок байт у колонок родной.
+    """
+    bus_ids = [bus.busId for bus in buses]
+    routes = [bus.route for bus in buses]
+    encoded_bus_ids = ''.join(bus_ids).encode()
+    encoded_routes = ''.join(routes).encode()
+    return b''.join((
+        BATCH_HEADER.pack(len(buses), len(encoded_bus_ids), len(encoded_routes), messages_number, errors_number),
+        array('d', [bus.lat for bus in buses]).tobytes(),
+        array('d', [bus.lng for bus in buses]).tobytes(),
+        array('d', timestamps).tobytes(),
+        array('H', map(len, bus_ids)).tobytes(),
+        array('H', map(len, routes)).tobytes(),
+        encoded_bus_ids,
+        encoded_routes,
+    ))
+
+
+def split_by_lengths(text, lengths):
+    ends = np.cumsum(lengths).tolist()
+    return [text[start:end] for start, end in zip([0, *ends[:-1]], ends)]
+
+
+def unpack_batch(batch):
+    """Возвращает из пачки pack_batch списки busId и маршрутов, массивы numpy lat, lng и времени отправки,
+    число принятых воркером сообщений и число ошибок проверки.
+    """
+    buses_number, bus_ids_size, routes_size, messages_number, errors_number = BATCH_HEADER.unpack_from(batch)
+    offset = BATCH_HEADER.size
+    lats = np.frombuffer(batch, dtype='f8', count=buses_number, offset=offset)
+    lngs = np.frombuffer(batch, dtype='f8', count=buses_number, offset=offset + 8 * buses_number)
+    timestamps = np.frombuffer(batch, dtype='f8', count=buses_number, offset=offset + 16 * buses_number)
+    offset += 24 * buses_number
+    lengths = np.frombuffer(batch, dtype='u2', count=2 * buses_number, offset=offset)
+    offset += 4 * buses_number
+    bus_ids = split_by_lengths(batch[offset:offset + bus_ids_size].decode(), lengths[:buses_number])
+    offset += bus_ids_size
+    routes = split_by_lengths(batch[offset:offset + routes_size].decode(), lengths[buses_number:])
+    return bus_ids, routes, lats.copy(), lngs.copy(), timestamps.copy(), messages_number, errors_number
+
+
+def collect_updates(updates, buses, timestamp=None):
+    """Копит автобусы до отправки. Если автобус успел прислать координаты несколько раз, уйдут последние.
+
+    timestamp — когда имитатор отправил сообщение. Если он его не указал, считается время прихода в воркер.
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    for bus in buses:
+        updates[bus.busId] = bus, timestamp
+
+
+async def flush_updates(stream, updates, messages_counter, errors_counter):
+    """Раз в FLUSH_DELAY отправляет координатору всё, что воркер успел принять и проверить.
+
+    busId в одной пачке не повторяются, на это рассчитывает store_batch координатора. Вместе
+    с автобусами уходит, на сколько выросли счётчики сообщений и ошибок воркера, чтобы метрики
+    координатора учитывали их и с --workers. Если приходили только ошибки, пачка уходит без автобусов.
+    """
+    flushed_messages, flushed_errors = 0, 0
+    while True:
+        messages_number = messages_counter.value - flushed_messages
+        errors_number = errors_counter.value - flushed_errors
+        if updates or messages_number or errors_number:
+            buses, timestamps = zip(*updates.values()) if updates else ((), ())
+            batch = pack_batch(buses, timestamps, messages_number, errors_number)
+            updates.clear()
+            flushed_messages += messages_number
+            flushed_errors += errors_number
+            await stream.send_all(HEADER.pack(len(batch)) + batch)
+        await trio.sleep(FLUSH_DELAY)
+
+
+async def receive_exactly(stream, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = await stream.receive_some(size - len(data))
+        if not chunk:
+            raise trio.EndOfChannel
+        data += chunk
+    return data
+
+
+async def receive_updates(stream, store_batch):
+    try:
+        while True:
+            header = await receive_exactly(stream, HEADER.size)
+            batch = await receive_exactly(stream, HEADER.unpack(header)[0])
+            store_batch(*unpack_batch(batch))
+    except trio.EndOfChannel:
+        logger.error('Ingest worker disconnected')
+
+
+async def serve_shards(workers_number, run_worker, worker_args, store_batch):
+    """Запускает процессы-воркеры, которые разбирают сообщения имитатора вместо основного процесса.
+
+    Воркеры слушают порт для автобусов вместе через SO_REUSEPORT, сами разбирают и проверяют
+    сообщения и присылают координатору двоичные пачки pack_batch через локальный сокет.
+    Координатор применяет пачку целиком сравнениями и присваиваниями numpy, а не по одному автобусу.
+    Хранилище, индексы и рассылка остаются в координаторе, поэтому его скорость ограничивает приём
+    при любом числе воркеров.
+    """
+    listeners = await trio.open_tcp_listeners(0, host='127.0.0.1')
+    coordinator_port = listeners[0].socket.getsockname()[1]
+
+    context = multiprocessing.get_context('spawn')
+    workers = [
+        context.Process(target=run_worker, args=(*worker_args, coordinator_port), daemon=True)
+        for _ in range(workers_number)
+    ]
+    for worker in workers:
+        worker.start()
+
+    try:
+        await trio.serve_listeners(partial(receive_updates, store_batch=store_batch), listeners)
+    finally:
+        for worker in workers:
+            worker.terminate()
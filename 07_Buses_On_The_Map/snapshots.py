@@ -0,0 +1,65 @@
+import json
+import os
+import struct
+from array import array
+
+
+# Метка формата, время записи (unix time) и число автобусов. Дальше колонки float64 lat, lng
+# и возраст последних координат в секундах, а в конце JSON [busIds, routes]
+SNAPSHOT_HEADER = struct.Struct('<4sdI')
+SNAPSHOT_MAGIC = b'BUS1'
+
+
+def dump_snapshot(saved_at, bus_ids, routes, lats, lngs, ages):
+    return b''.join((
+        SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, saved_at, len(bus_ids)),
+        lats.tobytes(),
+        lngs.tobytes(),
+        ages.tobytes(),
+        json.dumps([bus_ids, routes], ensure_ascii=False).encode(),
+    ))
+
+
+def write_snapshot(path, snapshot):
+    """Пишет снимок во временный файл и подменяет им прежний, так что на диске всегда целый снимок."""
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, 'wb') as file:
+        file.write(dump_snapshot(*snapshot))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, path)
+
+
+def read_snapshot(path):
+    """Возвращает время записи снимка и колонки (busIds, routes, lats, lngs, возраст координат).
+
+    Если файл не похож на снимок, бросает ValueError.
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+
+    if len(data) < SNAPSHOT_HEADER.size:
+        raise ValueError('Snapshot is too short')
+    magic, saved_at, buses_number = SNAPSHOT_HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError('Unknown snapshot format')
+
+    offset = SNAPSHOT_HEADER.size
+    columns = []
+    for _ in range(3):
+        column = array('d')
+        column.frombytes(data[offset:offset + buses_number * column.itemsize])
+        offset += buses_number * column.itemsize
+        columns.append(column)
+    lats, lngs, ages = columns
+    names = json.loads(data[offset:])
+    if not (isinstance(names, list) and len(names) == 2 and all(isinstance(column, list) for column in names)):
+        raise ValueError('Snapshot names are not [busIds, routes]')
+    bus_ids, routes = names
+    if not all(isinstance(name, str) for column in names for name in column):
+        raise ValueError('Snapshot names are not strings')
+
+    if not len(lats) == len(lngs) == len(ages) == len(bus_ids) == len(routes) == buses_number:
+        raise ValueError('Snapshot is truncated')
+
+    return saved_at, (bus_ids, routes, lats, lngs, ages)
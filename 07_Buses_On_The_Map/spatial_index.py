@@ -0,0 +1,154 @@
+import math
+from array import array
+
+import numpy as np
+
+
+CELL_SIZE = 0.01
+# Номерам строк и ячеек хватает 32 бит: строк меньше 2**31, а ячеек по широте при шаге 0.01 — всего 18000
+SLOT_TYPECODE = 'i'
+
+
+class GridIndex:
+    """Раскладывает строки BusStore по ячейкам сетки lat/lng.
+
+    По ячейкам видно, каким браузерам интересно движение автобуса, и поиск в окне проверяет только
+    строки из ячеек на краю окна. В ячейке лежит массив номеров строк, а для каждой строки помнятся её
+    ячейка и место в этом массиве, так что переезд автобуса — это пара присваиваний без перебора.
+    Номера строк совпадают с номерами строк BusStore, и удаляются они так же: на место удалённой
+    переезжает последняя.
+    """
+
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self._cells = {}
+        self._lat_cells = array(SLOT_TYPECODE)
+        self._lng_cells = array(SLOT_TYPECODE)
+        self._positions = array(SLOT_TYPECODE)
+
+    def __len__(self):
+        return len(self._positions)
+
+    @property
+    def cells_number(self):
+        return len(self._cells)
+
+    def get_cell(self, lat, lng):
+        return math.floor(lat / self.cell_size), math.floor(lng / self.cell_size)
+
+    def get_cell_range(self, bounds):
+        south, west = self.get_cell(bounds.south_lat, bounds.west_lng)
+        north, east = self.get_cell(bounds.north_lat, bounds.east_lng)
+        return south, west, north, east
+
+    def _get_slot_cell(self, slot):
+        return self._lat_cells[slot], self._lng_cells[slot]
+
+    def _put(self, slot, cell):
+        cell_slots = self._cells.get(cell)
+        if cell_slots is None:
+            cell_slots = self._cells[cell] = array(SLOT_TYPECODE)
+        self._positions[slot] = len(cell_slots)
+        self._lat_cells[slot], self._lng_cells[slot] = cell
+        cell_slots.append(slot)
+
+    def _discard(self, slot, cell):
+        cell_slots = self._cells[cell]
+        position = self._positions[slot]
+        last_slot = cell_slots.pop()
+        if last_slot != slot:
+            cell_slots[position] = last_slot
+            self._positions[last_slot] = position
+        if not cell_slots:
+            del self._cells[cell]
+
+    def add(self, lat, lng):
+        """Добавляет новую строку в конец и возвращает её ячейку."""
+        cell = self.get_cell(lat, lng)
+        self._lat_cells.append(0)
+        self._lng_cells.append(0)
+        self._positions.append(0)
+        self._put(len(self._positions) - 1, cell)
+        return cell
+
+    def move(self, slot, lat, lng):
+        """Возвращает прежнюю и новую ячейки строки."""
+        cell = self.get_cell(lat, lng)
+        old_cell = self._get_slot_cell(slot)
+        if old_cell != cell:
+            self._discard(slot, old_cell)
+            self._put(slot, cell)
+        return old_cell, cell
+
+    def move_many(self, slots, lats, lngs):
+        """Передвигает сразу много строк и возвращает множество ячеек, где что-то поменялось.
+
+        Ячейки считаются и сравниваются с прежними numpy, по одной переезжают только строки,
+        сменившие ячейку.
+        """
+        lat_cells = np.floor(lats / self.cell_size).astype(np.int64)
+        lng_cells = np.floor(lngs / self.cell_size).astype(np.int64)
+        old_lat_cells = np.frombuffer(self._lat_cells, dtype=SLOT_TYPECODE)[slots].astype(np.int64)
+        old_lng_cells = np.frombuffer(self._lng_cells, dtype=SLOT_TYPECODE)[slots].astype(np.int64)
+        moved = np.flatnonzero((lat_cells != old_lat_cells) | (lng_cells != old_lng_cells))
+
+        for slot, cell in zip(slots[moved].tolist(), zip(lat_cells[moved].tolist(), lng_cells[moved].tolist())):
+            self._discard(slot, self._get_slot_cell(slot))
+            self._put(slot, cell)
+
+        lat_cells = np.concatenate((lat_cells, old_lat_cells[moved]))
+        lng_cells = np.concatenate((lng_cells, old_lng_cells[moved]))
+        # Номер ячейки по широте — в старших 32 битах ключа, по долготе со сдвигом — в младших
+        keys = np.unique((lat_cells << 32) + (lng_cells + 2 ** 31))
+        return set(zip((keys >> 32).tolist(), ((keys & 0xFFFFFFFF) - 2 ** 31).tolist()))
+
+    def remove(self, slot):
+        """Удаляет строку, переносит на её место последнюю и возвращает ячейку удалённой."""
+        cell = self._get_slot_cell(slot)
+        self._discard(slot, cell)
+
+        last_slot = len(self._positions) - 1
+        if last_slot != slot:
+            last_cell = self._get_slot_cell(last_slot)
+            position = self._positions[last_slot]
+            self._cells[last_cell][position] = slot
+            self._positions[slot] = position
+            self._lat_cells[slot], self._lng_cells[slot] = last_cell
+
+        self._lat_cells.pop()
+        self._lng_cells.pop()
+        self._positions.pop()
+        return cell
+
+    def load(self, lats, lngs):
+        """Заменяет всё содержимое строками с готовыми координатами, считая ячейки numpy."""
+        lat_cells = np.floor(np.asarray(lats, dtype='f8') / self.cell_size).astype(np.int64)
+        lng_cells = np.floor(np.asarray(lngs, dtype='f8') / self.cell_size).astype(np.int64)
+        self._cells = {}
+        self._lat_cells = array(SLOT_TYPECODE, lat_cells.astype(SLOT_TYPECODE).tobytes())
+        self._lng_cells = array(SLOT_TYPECODE, lng_cells.astype(SLOT_TYPECODE).tobytes())
+        self._positions = array(SLOT_TYPECODE, bytes(self._lat_cells.itemsize * len(self._lat_cells)))
+        for slot, cell in enumerate(zip(lat_cells.tolist(), lng_cells.tolist())):
+            self._put(slot, cell)
+
+    def get_cells(self, cell_range):
+        """Возвращает номера строк в занятых ячейках диапазона и признак того, что ячейка не на его краю.
+
+        Диапазон — (south, west, north, east) из get_cell_range.
+        """
+        south, west, north, east = cell_range
+
+        # При сильном отдалении карты дешевле пройти по занятым ячейкам, чем по всем ячейкам окна
+        if (north - south + 1) * (east - west + 1) > len(self._cells):
+            cells = [cell for cell in self._cells if south <= cell[0] <= north and west <= cell[1] <= east]
+        else:
+            cells = [
+                (lat_index, lng_index)
+                for lat_index in range(south, north + 1)
+                for lng_index in range(west, east + 1)
+                if (lat_index, lng_index) in self._cells
+            ]
+
+        for lat_index, lng_index in cells:
+            is_inner = south < lat_index < north and west < lng_index < east
+            yield self._cells[lat_index, lng_index], is_inner
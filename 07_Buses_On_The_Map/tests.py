@@ -1,13 +1,41 @@
 import json
+import os
+import random
+import struct
+import time
+from array import array
+from glob import glob
 
+import numpy as np
+import pytest
 import trio
+import trio.testing
+from pydantic import ValidationError
 from trio_websocket import open_websocket_url
 
+from expiry import LastSeen
+from fake_bus import prepare_emulated_buses
+from history import PositionHistory
+from messages import BinaryEncoder, JsonEncoder, make_delta
+from metrics import Counter, Histogram, Metrics
+from bus_store import BusStore, add_rows, put_rows, take_rows
+from broadcaster import Broadcaster
+from clusters import ClusterIndex
+from models import Bus, WindowBounds
+from serializers import HistoryRequestSerializer, parse_browser_message, parse_buses, parse_buses_fast
+from sessions import Mailbox, SessionRegistry
+from shards import HEADER, collect_updates, flush_updates, pack_batch, receive_exactly, unpack_batch
+from snapshots import SNAPSHOT_HEADER, SNAPSHOT_MAGIC, read_snapshot, write_snapshot
+from spatial_index import GridIndex
+from utils.routes import load_catalogue, load_compiled_routes, load_routes
+from utils.traffic import read_frames, write_frame
+
 
 async def run_browser_wrong_data():
     async with open_websocket_url('ws://127.0.0.1:8080', ssl_context=None) as ws:
-        messages = [' ', '[]']
-        errors = ['value_error.jsondecode', 'value_error.missing']
+        # После координат NaN сервер должен остаться жив и ответить на следующее сообщение
+        messages = [' ', '{"busId": "a", "lat": NaN, "lng": 37.6, "route": "1"}', '[]']
+        errors = ['value_error.jsondecode', 'value_error', 'value_error.missing']
         for message, error in zip(messages, errors):
             await ws.send_message(message)
             answer = json.loads(await ws.get_message())
@@ -16,10 +44,15 @@ async def run_browser_wrong_data():
 
 async def run_bus_wrong_data():
     async with open_websocket_url('ws://127.0.0.1:8000', ssl_context=None) as ws:
-        messages = [' ', '[]']
-        errors = ['value_error.jsondecode', 'value_error.missing']
+        bounds = {'msgType': 'newBounds', 'data': {'south_lat': 55.7, 'north_lat': 55.8, 'west_lng': 37.5, 'east_lng': 37.7}}
+        messages = [
+            ' ',
+            json.dumps({**bounds, 'data': {**bounds['data'], 'south_lat': float('inf')}}),
+            json.dumps({**bounds, 'data': {**bounds['data'], 'zoom': 5000}}),
+            '[]',
+        ]
+        errors = ['value_error.jsondecode', 'value_error', 'value_error', 'value_error.missing']
         for message, error in zip(messages, errors):
-            await ws.get_message()
             await ws.send_message(message)
             answer = json.loads(await ws.get_message())
             assert answer[0]['type'] == error
@@ -31,3 +64,545 @@ def test_broser_wrong_data():
 
 def test_bus_wrong_data():
     trio.run(run_bus_wrong_data)
+
+
+def test_bus_store_find_inside():
+    random.seed(0)
+    store = BusStore()
+    buses = {}
+    for bus_index in range(1000):
+        bus = Bus(str(bus_index), random.uniform(55.6, 55.9), random.uniform(37.4, 37.8), '1')
+        buses[bus.busId] = bus
+        store.update(bus)
+
+    moved_bus = Bus('0', 55.75, 37.6, '1')
+    buses[moved_bus.busId] = moved_bus
+    old_position, old_cell, cell = store.update(moved_bus)
+    assert cell == store.index.get_cell(55.75, 37.6) and old_cell == store.index.get_cell(*old_position)
+    assert store.remove('1')[1] == store.index.get_cell(buses['1'].lat, buses['1'].lng)
+    del buses['1']
+
+    # Строки переезжают и между ячейками сетки, и между номерами строк при удалении
+    for bus_id in random.sample(sorted(buses), 300):
+        if random.random() < 0.5:
+            store.remove(bus_id)
+            del buses[bus_id]
+        else:
+            buses[bus_id] = Bus(bus_id, random.uniform(55.6, 55.9), random.uniform(37.4, 37.8), '2')
+            store.update(buses[bus_id])
+
+    bounds = WindowBounds(south_lat=55.72, north_lat=55.77, east_lng=37.65, west_lng=37.54)
+    expected = {bus.busId: (bus.lat, bus.lng, bus.route) for bus in buses.values() if bus.is_inside(bounds)}
+    assert store.find_inside(bounds) == expected
+    assert len(store.index) == len(buses)
+
+    restored = BusStore()
+    restored.load_columns(*store.get_columns())
+    assert restored.find_inside(bounds) == expected
+    assert store.get('999') == buses['999']
+    assert len(store) == len(buses)
+    assert not store.find_inside(WindowBounds())
+
+
+def test_bus_store_columns():
+    column = array('d', [1, 2, 3])
+    rows = np.array([0, 2])
+    put_rows(column, rows, [10, 30])
+    add_rows(column, rows, 1)
+    assert take_rows(column, rows).tolist() == [11, 31]
+    # Помощники не оставляют представлений numpy, так что колонка может расти
+    column.append(4)
+    assert column.tolist() == [11, 2, 31, 4]
+
+    store = BusStore()
+    store.update(Bus('1', 55.7, 37.6, ''.join(['1', '0'])))
+    store.update_many(['1', '2'], ['10', ''.join(['1', '0'])], np.array([55.7, 55.8]), np.array([37.6, 37.7]))
+    assert store.get('1').route is store.get('2').route
+
+
+def test_sessions_find_interested():
+    index = GridIndex(cell_size=0.01)
+    sessions = SessionRegistry(index)
+    first, second = sessions.add(ws=None), sessions.add(ws=None)
+    sessions.update_bounds(first, south_lat=55.72, north_lat=55.77, east_lng=37.65, west_lng=37.54)
+    sessions.update_bounds(second, south_lat=55.80, north_lat=55.85, east_lng=37.65, west_lng=37.54)
+
+    cell = index.get_cell(55.75, 37.6)
+    assert sessions.find_interested(cell) == {first}
+
+    sessions.update_bounds(second, south_lat=55.74, north_lat=55.76, east_lng=37.61, west_lng=37.59)
+    assert sessions.find_interested(cell) == {first, second}
+
+    sessions.remove(first)
+    assert sessions.find_interested(cell) == {second}
+
+
+async def run_broadcaster_rate_limit():
+    buses = BusStore()
+    sessions = SessionRegistry(buses.index)
+    broadcaster = Broadcaster(buses, sessions, ClusterIndex(), max_rate=10)
+    session = sessions.add(ws=None)
+    idle_session = sessions.add(ws=None)
+    sessions.update_bounds(session, south_lat=55.72, north_lat=55.77, east_lng=37.65, west_lng=37.54)
+    sessions.update_bounds(idle_session, south_lat=55.80, north_lat=55.85, east_lng=37.65, west_lng=37.54)
+    assert broadcaster.broadcast(now=0) is None
+    await idle_session.mailbox.get()
+    await session.mailbox.get()
+
+    bus = Bus('a', 55.75, 37.6, '1')
+    _, *cells = buses.update(bus)
+    broadcaster.notify(bus.busId, *cells)
+    assert sessions.dirty == {session}
+    assert broadcaster.broadcast(now=0.05) == 0.1
+    assert sessions.dirty == {session} and not len(session.mailbox)
+
+    assert broadcaster.broadcast(now=0.1) is None
+    message, visible, changed_at = await session.mailbox.get()
+    assert visible == {'a': (55.75, 37.6, '1')} and changed_at is not None
+    assert not sessions.dirty
+
+
+def test_broadcaster_rate_limit():
+    trio.run(run_broadcaster_rate_limit)
+
+
+async def run_broadcaster_survives_encoder_error():
+    buses = BusStore()
+    sessions = SessionRegistry(buses.index)
+    broadcaster = Broadcaster(buses, sessions, ClusterIndex(), max_rate=0)
+    binary_session, json_session = sessions.add(ws=None, encoding='binary'), sessions.add(ws=None)
+    for session in (binary_session, json_session):
+        sessions.update_bounds(session, south_lat=0, north_lat=5000, east_lng=180, west_lng=-180)
+    # В int32 двоичного формата такая широта не помещается
+    buses.update(Bus('a', 3000, 37.6, '1'))
+
+    broadcaster.broadcast(now=0)
+    assert not len(binary_session.mailbox) and not sessions.dirty
+    message, visible, _ = await json_session.mailbox.get()
+    assert 'a' in visible
+
+
+async def run_broadcaster_shares_messages():
+    buses = BusStore()
+    sessions = SessionRegistry(buses.index)
+    broadcaster = Broadcaster(buses, sessions, ClusterIndex(), max_rate=0)
+    first, second, third = sessions.add(ws=None), sessions.add(ws=None), sessions.add(ws=None)
+    # Окна разные, но покрывают одни и те же ячейки сетки, а третье не захватывает автобус b
+    sessions.update_bounds(first, south_lat=55.721, north_lat=55.769, east_lng=37.649, west_lng=37.541)
+    sessions.update_bounds(second, south_lat=55.722, north_lat=55.768, east_lng=37.648, west_lng=37.542)
+    sessions.update_bounds(third, south_lat=55.722, north_lat=55.768, east_lng=37.644, west_lng=37.542)
+    assert first.cells == second.cells == third.cells
+    for bus in (Bus('a', 55.75, 37.6, '1'), Bus('b', 55.75, 37.646, '2')):
+        _, *cells = buses.update(bus)
+        broadcaster.notify(bus.busId, *cells)
+
+    broadcaster.broadcast(now=0)
+    messages = {}
+    for session in (first, second, third):
+        messages[session], session.visible, _ = await session.mailbox.get()
+    assert messages[first] is messages[second] and first.visible is second.visible
+    assert set(first.visible) == {'a', 'b'} and set(third.visible) == {'a'}
+
+    _, *cells = buses.update(Bus('a', 55.751, 37.6, '1'))
+    broadcaster.notify('a', *cells)
+    broadcaster.broadcast(now=1)
+    first_message, _, _ = await first.mailbox.get()
+    second_message, _, _ = await second.mailbox.get()
+    assert first_message is second_message and '"moved": [{"busId": "a"' in first_message
+
+
+def test_broadcaster_shares_messages():
+    trio.run(run_broadcaster_shares_messages)
+
+
+async def run_session_stats():
+    buses = BusStore()
+    sessions = SessionRegistry(buses.index)
+    broadcaster = Broadcaster(buses, sessions, ClusterIndex(), max_rate=0)
+    session = sessions.add(ws=None)
+    sessions.update_bounds(session, south_lat=55.72, north_lat=55.77, east_lng=37.65, west_lng=37.54)
+    broadcaster.broadcast(now=0)
+    await session.mailbox.get()
+
+    # Позже пришли координаты, которые имитатор отправил раньше: задержка считается от них
+    for bus, timestamp in ((Bus('a', 55.75, 37.6, '1'), 1000.0), (Bus('b', 55.75, 37.61, '1'), 990.0)):
+        _, *cells = buses.update(bus)
+        broadcaster.notify(bus.busId, *cells, changed_at=timestamp)
+    broadcaster.broadcast(now=1)
+
+    # Браузер не забрал сообщение, и следующее его вытесняет, но задержку считает от вытесненных координат
+    _, *cells = buses.update(Bus('a', 55.751, 37.6, '1'))
+    broadcaster.notify('a', *cells)
+    broadcaster.broadcast(now=2)
+    assert session.as_dict() == {
+        'session_id': session.session_id, 'encoding': 'json',
+        'messages': 1, 'bytes': 0, 'dropped': 1, 'mailbox_depth': 1,
+    }
+
+    _, visible, changed_at = await session.mailbox.get()
+    assert visible.keys() == {'a', 'b'} and changed_at == 990.0
+    assert (session.as_dict()['messages'], session.as_dict()['mailbox_depth']) == (2, 0)
+
+
+def test_session_stats():
+    trio.run(run_session_stats)
+
+
+def test_broadcaster_survives_encoder_error():
+    trio.run(run_broadcaster_survives_encoder_error)
+
+
+def test_make_delta():
+    visible = {
+        'a': (55.75, 37.6, '1'),
+        'b': (55.76, 37.6, '2'),
+        'c': (55.77, 37.6, '3'),
+    }
+    buses_inside = {
+        'a': (55.75, 37.6, '1'),
+        'b': (55.761, 37.6, '2'),
+        'd': (55.78, 37.6, '4'),
+    }
+    encoder = JsonEncoder()
+    assert json.loads(make_delta(visible, buses_inside, encoder)) == {
+        'msgType': 'BusesUpdate',
+        'added': [{'busId': 'd', 'lat': 55.78, 'lng': 37.6, 'route': '4'}],
+        'moved': [{'busId': 'b', 'lat': 55.761, 'lng': 37.6}],
+        'removed': ['c'],
+    }
+    assert make_delta(buses_inside, buses_inside, encoder) is None
+
+    binary_delta = make_delta(visible, buses_inside, BinaryEncoder())
+    assert binary_delta == b''.join((
+        struct.pack('<BIII', 2, 1, 1, 1),
+        struct.pack('<iiH', 55780000, 37600000, 1), b'd', struct.pack('<H', 1), b'4',
+        struct.pack('<iiH', 55761000, 37600000, 1), b'b',
+        struct.pack('<H', 1), b'c',
+    ))
+
+
+def test_last_seen_pop_expired():
+    last_seen = LastSeen(ttl=10)
+    last_seen.touch('a', now=0)
+    last_seen.touch('b', now=1)
+    last_seen.touch('c', now=2)
+    last_seen.touch('a', now=5)
+
+    assert list(last_seen.pop_expired(now=11)) == ['b']
+    assert list(last_seen.pop_expired(now=13)) == ['c']
+    assert list(last_seen.pop_expired(now=15)) == ['a']
+    assert not len(last_seen)
+
+
+@pytest.mark.parametrize('message', [
+    '{"busId": "a", "lat": 55.75, "lng": 37, "route": "120"}',
+    '{"busId": 1, "lat": "55.75", "lng": 37.6, "route": 120}',
+    '{"msgType": "Buses", "buses": [{"busId": "a", "lat": 55.75, "lng": 37.6, "route": "120"}]}',
+    '{"busId": "a", "lat": 55.75, "lng": 37.6, "route": "120", "timestamp": 1700000000}',
+    '{"msgType": "Buses", "timestamp": 1700000000.5, "buses": [{"busId": "a", "lat": 55.7, "lng": 37.6, "route": "1"}]}',
+    '{"busId": "a", "lat": 55.75, "lng": 37.6, "route": "120", "timestamp": "1700000000"}',
+])
+def test_parse_buses_fast(message):
+    assert parse_buses_fast(message) == parse_buses(message)
+
+
+@pytest.mark.parametrize('message', [
+    ' ',
+    '[]',
+    '{"busId": "a", "lat": "north", "lng": 37.6, "route": "120"}',
+    '{"msgType": "Buses", "buses": [{"busId": "a", "lat": 55.75, "lng": 37.6}]}',
+    '{"busId": "a", "lat": NaN, "lng": 37.6, "route": "1"}',
+    '{"busId": "a", "lat": 55.75, "lng": -Infinity, "route": "1"}',
+    '{"msgType": "Buses", "buses": [{"busId": "a", "lat": 90.5, "lng": 37.6, "route": "1"}]}',
+    json.dumps({'busId': 'a', 'lat': 55.75, 'lng': 37.6, 'route': 'я' * 20_000}),
+    '{"busId": "a", "lat": 55.75, "lng": 37.6, "route": "1", "timestamp": Infinity}',
+    '{"msgType": "Buses", "timestamp": -1, "buses": [{"busId": "a", "lat": 55.75, "lng": 37.6, "route": "1"}]}',
+    json.dumps({'busId': 'a', 'lat': 10 ** 400, 'lng': 37.6, 'route': '1'}),
+    json.dumps({'msgType': 'Buses', 'buses': [{'busId': 'a', 'lat': 55.75, 'lng': -10 ** 400, 'route': '1'}]}),
+    json.dumps({'busId': 'a', 'lat': 55.75, 'lng': 37.6, 'route': '1', 'timestamp': 10 ** 400}),
+])
+def test_parse_buses_fast_errors(message):
+    with pytest.raises(ValidationError) as fast_error:
+        parse_buses_fast(message)
+    with pytest.raises(ValidationError) as error:
+        parse_buses(message)
+    assert fast_error.value.json() == error.value.json()
+
+
+async def run_mailbox():
+    mailbox = Mailbox()
+    mailbox.put('snapshot', {'a': (55.75, 37.6, '1')}, is_snapshot=True)
+    mailbox.put('delta', {}, is_snapshot=False)
+    assert len(mailbox) == 1 and mailbox.dropped == 1
+    assert await mailbox.get() == ('delta', {}, None)
+
+    mailbox.put('delta', {}, is_snapshot=False)
+    mailbox.put(None, {}, is_snapshot=False)
+    assert not len(mailbox) and mailbox.dropped == 2
+
+    with trio.move_on_after(0.1) as cancel_scope:
+        await mailbox.get()
+    assert cancel_scope.cancelled_caught
+    assert mailbox.sent == 1
+
+    # Ответы на запросы истории не вытесняют изменения и не меняют видимое браузером
+    mailbox.put('delta', {'a': (55.75, 37.6, '1')}, is_snapshot=False, changed_at=5)
+    mailbox.put_reply('getMotion', 'old motion')
+    mailbox.put_reply('getMotion', 'motion')
+    mailbox.put(None, {}, is_snapshot=False)
+    assert len(mailbox) == 1 and mailbox.dropped == 4
+    assert await mailbox.get() == ('motion', None, None)
+    mailbox.put('delta', {'a': (55.75, 37.6, '1')}, is_snapshot=False)
+    mailbox.put_reply('getTrails', 'trails')
+    mailbox.put_reply('getMotion', 'motion')
+    assert len(mailbox) == 3
+    assert [await mailbox.get() for _ in range(3)] == [
+        ('trails', None, None), ('motion', None, None), ('delta', {'a': (55.75, 37.6, '1')}, None),
+    ]
+    assert not len(mailbox) and mailbox.sent == 5
+
+
+def test_mailbox():
+    trio.run(run_mailbox)
+
+
+def test_cluster_index():
+    clusters = ClusterIndex(cell_sizes=(0.01, 0.1))
+    clusters.add(55.751, 37.601)
+    clusters.add(55.753, 37.603)
+    clusters.move((55.753, 37.603), 55.755, 37.605)
+    clusters.add(55.851, 37.601)
+    clusters.discard(55.851, 37.601)
+
+    bounds = WindowBounds(south_lat=55.7, north_lat=55.8, east_lng=37.7, west_lng=37.5)
+    [(lat, lng, count)] = clusters.find_clusters(bounds, zoom=4)
+    assert count == 2
+    assert abs(lat - 55.753) < 1e-9 and abs(lng - 37.603) < 1e-9
+
+
+def test_route_catalogue(tmp_path):
+    filepaths = sorted(glob(os.path.join('routes', '*.json')))
+    routes = []
+    for filepath in filepaths[:3]:
+        with open(filepath) as file:
+            routes.append(json.load(file))
+
+    cache_path = tmp_path / 'cache'
+    assert list(load_routes('routes', 3, cache_path)) == [
+        {'name': route['name'], 'coordinates': route['coordinates']} for route in routes
+    ]
+    assert len(load_catalogue('routes', -1, cache_path)) == len(filepaths)
+
+    route = load_catalogue('routes', 1, cache_path)[0]
+    assert route['points'] == len(routes[0]['coordinates'])
+    assert route['offset'] == 0
+
+
+def test_emulated_buses(tmp_path):
+    route, = load_routes('routes', 1, tmp_path / 'cache')
+    compiled_routes = load_compiled_routes('routes', 1, tmp_path / 'cache')
+
+    bus_id = f'emulator-{route["name"]}-0'
+    bus, = prepare_emulated_buses(compiled_routes, 1, 'emulator')
+    bus.position = 0
+    for lat, lng in route['coordinates'] * 2:
+        assert parse_buses_fast(bus.next_message()) == ([Bus(bus_id, lat, lng, bus_id)], None)
+
+
+def test_traffic_frames(tmp_path):
+    path = tmp_path / 'traffic.rec'
+    frames = [(0.0, 0, '{"busId": "c790сс"}'), (0.5, 3, '[]')]
+    with open(path, 'ab') as file:
+        for frame in frames:
+            write_frame(file, *frame)
+        file.write(b'\x00' * 5)
+
+    assert list(read_frames(path)) == frames
+
+
+def test_metrics():
+    metrics = Metrics()
+    counter = metrics.counter('messages')
+    histogram = metrics.histogram('latency', buckets=(0.1, 0.2, 0.4))
+    counter.inc(10)
+    for value in (0.05, 0.15, 0.15, 0.3, 1.5):
+        histogram.observe(value)
+
+    metrics.rotate(elapsed=2)
+    stats = metrics.as_dict()
+    assert stats['counters']['messages'] == {'total': 10, 'per_second': 5.0}
+    assert stats['histograms']['latency']['p50'] == 0.2
+    assert stats['histograms']['latency']['p99'] == 1.5
+
+    metrics.rotate(elapsed=1)
+    assert metrics.as_dict()['histograms']['latency']['count'] == 0
+    assert Histogram().as_dict()['p50'] == 0
+
+
+def test_snapshot(tmp_path):
+    store = BusStore()
+    for bus in (Bus('a', 55.75, 37.6, '1'), Bus('б', 55.8, 37.7, '2к')):
+        store.update(bus)
+    path = tmp_path / 'buses.snapshot'
+    write_snapshot(path, (1000.0, *store.get_columns(), array('d', [1.5, 20])))
+
+    saved_at, (bus_ids, routes, lats, lngs, ages) = read_snapshot(path)
+    assert saved_at == 1000.0 and list(ages) == [1.5, 20]
+
+    restored = BusStore()
+    restored.load_columns(bus_ids, routes, lats, lngs)
+    assert list(restored) == list(store) and restored.get('б') == store.get('б')
+
+    path.write_bytes(path.read_bytes()[:-3])
+    with pytest.raises(ValueError):
+        read_snapshot(path)
+
+    # JSON целый, но не [busIds, routes]
+    for names in (b'{}', b'1', b'[1, 2]', b'[[1], ["1"]]'):
+        path.write_bytes(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, 1000.0, 0) + names)
+        with pytest.raises(ValueError):
+            read_snapshot(path)
+
+
+def test_cluster_index_add_many():
+    points = [(55.751, 37.601), (55.753, 37.603), (-55.851, -37.601)]
+    clusters, bulk_clusters = ClusterIndex(cell_sizes=(0.01, 0.1)), ClusterIndex(cell_sizes=(0.01, 0.1))
+    for lat, lng in points:
+        clusters.add(lat, lng)
+    bulk_clusters.add_many(*zip(*points))
+
+    bounds = WindowBounds(south_lat=-90, north_lat=90, east_lng=180, west_lng=-180)
+    for zoom in (4, 12):
+        expected = sorted(clusters.find_clusters(bounds, zoom))
+        assert sorted(bulk_clusters.find_clusters(bounds, zoom)) == pytest.approx(expected)
+
+
+def test_position_history():
+    history = PositionHistory(size=3, memory_limit=2 * 3 * 3 * 8)
+    for step in range(5):
+        history.record('a', 55.75 + step * 0.001, 37.6, 1000 + step)
+    history.record('b', 55.8, 37.7, 1000)
+    history.record('c', 55.9, 37.8, 1000)
+
+    assert history.get_trail('a') == [(55.752, 37.6), (55.753, 37.6), (55.754, 37.6)]
+    assert history.get_trail('a', 1) == [(55.754, 37.6)]
+    assert 'c' not in history and history.find_trails(['b', 'c']) == {'b': [(55.8, 37.7)]}
+
+    speed, heading = history.find_motion(['a', 'b'])['a']
+    assert list(history.find_motion(['a', 'b'])) == ['a']
+    assert speed == pytest.approx(111.2, abs=0.1) and heading == pytest.approx(0)
+
+    history.discard('b')
+    history.record('c', 55.9, 37.8, 1000)
+    assert history.get_trail('c') == [(55.9, 37.8)]
+
+
+def test_batch_matches_single_updates():
+    random.seed(0)
+    buses = [Bus(f'бус-{index}', random.uniform(55.6, 55.9), random.uniform(37.4, 37.8), '1') for index in range(300)]
+    single = BusStore(), ClusterIndex(cell_sizes=(0.01, 0.1)), PositionHistory(size=3, memory_limit=250 * 3 * 3 * 8)
+    bulk = BusStore(), ClusterIndex(cell_sizes=(0.01, 0.1)), PositionHistory(size=3, memory_limit=250 * 3 * 3 * 8)
+
+    for step in range(3):
+        # Часть автобусов сдвигается в соседние ячейки, часть появляется впервые
+        batch = [
+            Bus(bus.busId, bus.lat + step * random.uniform(-0.02, 0.02), bus.lng, str(step))
+            for bus in random.sample(buses, 200)
+        ]
+        bus_ids, routes, lats, lngs, timestamps, *_ = unpack_batch(pack_batch(batch, [step] * len(batch)))
+        assert timestamps.tolist() == [step] * len(batch)
+        assert [Bus(*bus) for bus in zip(bus_ids, lats.tolist(), lngs.tolist(), routes)] == batch
+
+        store, clusters, history = single
+        expected_cells = set()
+        for bus in batch:
+            old_position, old_cell, cell = store.update(bus)
+            clusters.move(old_position, bus.lat, bus.lng)
+            history.record(bus.busId, bus.lat, bus.lng, step)
+            expected_cells.update((old_cell, cell))
+        expected_cells.discard(None)
+
+        store, clusters, history = bulk
+        old_lats, old_lngs, cells = store.update_many(bus_ids, routes, lats, lngs)
+        clusters.move_many(old_lats, old_lngs, lats, lngs)
+        history.record_many(bus_ids, lats, lngs, step)
+        assert cells == expected_cells
+
+    bounds = WindowBounds(south_lat=55.7, north_lat=55.8, east_lng=37.7, west_lng=37.5)
+    assert bulk[0].find_inside(bounds) == single[0].find_inside(bounds)
+    assert len(bulk[0].index) == len(single[0].index) == len(single[0])
+    clusters, bulk_clusters = sorted(single[1].find_clusters(bounds, 12)), sorted(bulk[1].find_clusters(bounds, 12))
+    assert len(bulk_clusters) == len(clusters)
+    assert all(bulk_cluster == pytest.approx(cluster) for bulk_cluster, cluster in zip(bulk_clusters, clusters))
+    assert len(bulk[2]) == len(single[2]) == 250
+    assert bulk[2].find_trails(bus_ids) == single[2].find_trails(bus_ids)
+
+
+def test_frame_timestamps_reach_coordinator():
+    updates = {}
+    messages = (
+        '{"busId": "a", "lat": 55.75, "lng": 37.6, "route": "1", "timestamp": 1000}',
+        '{"msgType": "Buses", "buses": [{"busId": "b", "lat": 55.7, "lng": 37.5, "route": "2"}]}',
+    )
+    for message in messages:
+        collect_updates(updates, *parse_buses_fast(message))
+    bus_ids, _, _, _, timestamps, _, _ = unpack_batch(pack_batch(*zip(*updates.values())))
+
+    assert bus_ids == ['a', 'b']
+    # Без timestamp в сообщении воркер ставит время его прихода
+    assert timestamps[0] == 1000 and timestamps[1] == pytest.approx(time.time(), abs=60)
+
+
+async def run_flush_worker_counters():
+    updates, messages, errors = {}, Counter(), Counter()
+    send_stream, receive_stream = trio.testing.memory_stream_pair()
+
+    async def receive_batch():
+        header = await receive_exactly(receive_stream, HEADER.size)
+        return unpack_batch(await receive_exactly(receive_stream, HEADER.unpack(header)[0]))
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(flush_updates, send_stream, updates, messages, errors)
+        collect_updates(updates, [Bus('a', 55.75, 37.6, '1')], timestamp=1000)
+        messages.inc(2)
+        errors.inc()
+        bus_ids, *_, messages_number, errors_number = await receive_batch()
+        assert (bus_ids, messages_number, errors_number) == (['a'], 2, 1)
+
+        # Одни ошибки тоже доходят до координатора, в пачке без автобусов
+        messages.inc()
+        errors.inc()
+        bus_ids, *_, messages_number, errors_number = await receive_batch()
+        assert (bus_ids, messages_number, errors_number) == ([], 1, 1)
+        nursery.cancel_scope.cancel()
+
+
+def test_flush_worker_counters():
+    trio.run(run_flush_worker_counters)
+
+
+def test_parse_browser_message():
+    request = parse_browser_message('{"msgType": "getTrails", "data": {"points": 5}}')
+    assert isinstance(request, HistoryRequestSerializer) and request.data.points == 5
+    assert parse_browser_message('{"msgType": "getMotion"}').data.points is None
+
+    bounds = parse_browser_message(json.dumps({
+        'msgType': 'newBounds',
+        'data': {'south_lat': 55.7, 'north_lat': 55.8, 'west_lng': 37.5, 'east_lng': 37.7},
+    }))
+    assert bounds.data.south_lat == 55.7
+
+    with pytest.raises(ValidationError):
+        parse_browser_message('{"msgType": "getTrails", "data": {"points": 0}}')
+    with pytest.raises(ValidationError):
+        parse_browser_message('[1, 2]')
+    with pytest.raises(ValidationError):
+        parse_browser_message(json.dumps({
+            'msgType': 'newBounds',
+            'data': {'south_lat': float('nan'), 'north_lat': 55.8, 'west_lng': 37.5, 'east_lng': 190},
+        }))
+    # Целые, которые не помещаются во float, отклоняются как обычные ошибки проверки, а не OverflowError
+    for field in ('south_lat', 'zoom'):
+        data = {'south_lat': 55.7, 'north_lat': 55.8, 'west_lng': 37.5, 'east_lng': 37.7, field: 10 ** 400}
+        with pytest.raises(ValidationError):
+            parse_browser_message(json.dumps({'msgType': 'newBounds', 'data': data}))
@@ -2,8 +2,101 @@ import json
 import os
 from glob import glob
 
+import numpy as np
 
-def load_routes(directory_path, routes_number):
-    for filepath in glob(os.path.join(directory_path, '*.json'))[:routes_number]:
-        with open(filepath) as file:
-            yield json.load(file)
+
+ROUTES_CACHE_PATH = 'routes_cache'
+COORDINATES_DTYPE = np.dtype('<f8')
+POINT_SIZE = 2 * COORDINATES_DTYPE.itemsize
+
+
+def get_catalogue_paths(cache_path):
+    return os.path.join(cache_path, 'index.json'), os.path.join(cache_path, 'coordinates.bin')
+
+
+def compile_routes(directory_path, cache_path):
+    """Собирает каталог маршрутов: координаты всех маршрутов подряд в одном файле и оглавление к нему.
+
+    Маршруты идут по именам файлов, поэтому порядок не зависит от файловой системы. Для каждого маршрута
+    в оглавлении — имя, файл, число точек и смещение его координат в байтах.
+    """
+    index_path, coordinates_path = get_catalogue_paths(cache_path)
+    os.makedirs(cache_path, exist_ok=True)
+
+    catalogue, offset = [], 0
+    with open(f'{coordinates_path}.tmp', 'wb') as coordinates_file:
+        for filepath in sorted(glob(os.path.join(directory_path, '*.json'))):
+            with open(filepath) as file:
+                route = json.load(file)
+            coordinates = np.array(route['coordinates'], dtype=COORDINATES_DTYPE).reshape(-1, 2)
+            coordinates_file.write(coordinates.tobytes())
+            catalogue.append({
+                'name': route['name'],
+                'path': os.path.basename(filepath),
+                'points': len(coordinates),
+                'offset': offset,
+            })
+            offset += coordinates.nbytes
+
+    with open(f'{index_path}.tmp', 'w') as file:
+        json.dump(catalogue, file, ensure_ascii=False)
+    # Оглавление подменяется последним: по нему видно, что каталог собран целиком
+    os.replace(f'{coordinates_path}.tmp', coordinates_path)
+    os.replace(f'{index_path}.tmp', index_path)
+
+
+def is_catalogue_fresh(directory_path, cache_path, filenames=()):
+    """Проверяет каталог по времени изменения папки с маршрутами и только тех файлов, что понадобятся.
+
+    Добавление и удаление файлов меняет время изменения папки, так что весь корпус перебирать не нужно.
+    """
+    index_path, _ = get_catalogue_paths(cache_path)
+    if not os.path.exists(index_path):
+        return False
+    catalogue_mtime = os.path.getmtime(index_path)
+    return all(
+        os.path.getmtime(path) <= catalogue_mtime
+        for path in [directory_path, *(os.path.join(directory_path, filename) for filename in filenames)]
+    )
+
+
+def read_catalogue(cache_path):
+    index_path, _ = get_catalogue_paths(cache_path)
+    with open(index_path) as file:
+        return json.load(file)
+
+
+def load_catalogue(directory_path, routes_number=None, cache_path=ROUTES_CACHE_PATH):
+    """Возвращает оглавление первых routes_number маршрутов, при необходимости пересобрав каталог.
+
+    Если routes_number не задан или отрицательный, возвращает все маршруты.
+    """
+    if routes_number is not None and routes_number < 0:
+        routes_number = None
+
+    if is_catalogue_fresh(directory_path, cache_path):
+        catalogue = read_catalogue(cache_path)[:routes_number]
+        if is_catalogue_fresh(directory_path, cache_path, [route['path'] for route in catalogue]):
+            return catalogue
+
+    compile_routes(directory_path, cache_path)
+    return read_catalogue(cache_path)[:routes_number]
+
+
+def load_compiled_routes(directory_path, routes_number, cache_path=ROUTES_CACHE_PATH):
+    """Отдаёт маршруты по одному, координаты — массив numpy (N x 2), отображённый в память с диска."""
+    _, coordinates_path = get_catalogue_paths(cache_path)
+    for route in load_catalogue(directory_path, routes_number, cache_path):
+        coordinates = np.memmap(
+            coordinates_path,
+            dtype=COORDINATES_DTYPE,
+            mode='r',
+            offset=route['offset'],
+            shape=(route['points'], 2),
+        )
+        yield {'name': route['name'], 'coordinates': coordinates}
+
+
+def load_routes(directory_path, routes_number, cache_path=ROUTES_CACHE_PATH):
+    for route in load_compiled_routes(directory_path, routes_number, cache_path):
+        yield {'name': route['name'], 'coordinates': route['coordinates'].tolist()}
@@ -0,0 +1,27 @@
+import struct
+
+
+# Время от начала записи в секундах, номер соединения имитатора и длина сообщения в байтах
+FRAME_HEADER = struct.Struct('<dHI')
+
+
+def write_frame(file, timestamp, connection, message):
+    payload = message.encode()
+    file.write(FRAME_HEADER.pack(timestamp, connection, len(payload)) + payload)
+
+
+def read_frames(path):
+    """Отдаёт (timestamp, connection, message) по порядку записи.
+
+    Недописанный кадр в конце файла, например после аварийной остановки записи, пропускается.
+    """
+    with open(path, 'rb') as file:
+        while True:
+            header = file.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return
+            timestamp, connection, size = FRAME_HEADER.unpack(header)
+            payload = file.read(size)
+            if len(payload) < size:
+                return
+            yield timestamp, connection, payload.decode()